@@ -1,7 +1,11 @@
 import os
+import sys
 import json
 import ycm_core
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "python"))
+from bbcode.common import cache
+
 BUILD_DIRECTORY = 'build'
 SRC_LANG = {
     'cuda': ['.cuh', '.cu'],
@@ -9,8 +13,11 @@ SRC_LANG = {
 }
 
 def GCC_BIN(flags, binary):
-    with os.popen(binary + " -dumpversion") as f:
-        version = f.readline().strip()
+    try:
+        version = cache.probe(binary, "-dumpversion")
+    except (OSError, RuntimeError):
+        # compiler is missing, the empty version as the popen before
+        version = ""
 
     flag = "-I/usr/include/c++/" + version
     if flag not in flags:
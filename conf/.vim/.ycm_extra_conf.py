@@ -4,6 +4,7 @@ import os
 from os import path
 import platform
 import json
+import functools
 
 from typing import Dict, Sequence, Tuple, List, Callable
 
@@ -123,6 +124,15 @@ class CompilationBinaryFlager:
     """
     __SUPPORTED_BINS__ = ["gcc", "g++", "cc", "c++"]
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def DumpVersion(compile_binary : str) -> str:
+        """ Cached in the vim process, since the settings are queried
+                for every opened file.
+        """
+        with os.popen(compile_binary + " -dumpversion") as f:
+            return f.readline().strip()
+
     @staticmethod
     @CPatchFlager.register_flager(deps=["compile_binary"], os_type=[OS.Linux])
     def FindCompilationLibrary(flags : Flags, params : Params):
@@ -135,9 +145,7 @@ class CompilationBinaryFlager:
         if not is_supported:
             return True
 
-        with os.popen(compile_binary + " -dumpversion") as f:
-            version = f.readline().strip()
-
+        version = CompilationBinaryFlager.DumpVersion(compile_binary)
         flag = "-I/usr/include/c++/%s" % version
         flags.append(flag)
 
@@ -1,6 +1,5 @@
 """ Code Core Submodule Initialization Main
 """
-import os
 from os import path
 
 from bbcode.common import base, cmd
@@ -55,16 +54,16 @@ int main(int argc, char **argv) {
             help="project name, and create sub directory")
 @cmd.module("code.init", as_main=True)
 def init_code(args):
-    code_root = args.root or os.getcwd()
+    code_root = base.abspath(args.root or "")
     code_path = path.join(code_root, args.name)
 
     code_core = path.join(base.BBCODE_ROOT, "cpp")
     core_relative_path = path.relpath(code_core, start=code_path)
 
-    with base.enter(code_path, create=True):
-        with open(path.join(code_path, "main.cpp"), "w") as f:
-            f.write(MAIN_CODE)
+    base.make_dirs(code_path)
+    with open(path.join(code_path, "main.cpp"), "w") as f:
+        f.write(MAIN_CODE)
 
-        with open(path.join(code_path, "Makefile"), "w") as f:
-            f.write(MAKEFILE.format_map(SafeDict(
-                link_path=core_relative_path)))
+    with open(path.join(code_path, "Makefile"), "w") as f:
+        f.write(MAKEFILE.format_map(SafeDict(
+            link_path=core_relative_path)))
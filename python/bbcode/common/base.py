@@ -1,42 +1,283 @@
 import os
 from os import path
+import time
+import shlex
+import select
 import logging
+import threading
+import contextvars
 import subprocess
+from concurrent import futures
+
+from . import trace
 
 bash_logger = logging.getLogger("bash")
 
 BBCODE_ROOT = path.abspath(
     path.join(__file__, "../../.."))
 
+CACHE_ROOT = path.join(
+    os.environ.get("XDG_CACHE_HOME", path.expanduser("~/.cache")),
+    "bbcode")
+
+# logical working directory of current context, which is changed
+#   via `enter` instead of `os.chdir`, so that threads can work in
+#   different directories concurrently.
+__CWD__ = contextvars.ContextVar("bbcode_cwd", default=None)
+
+def getcwd():
+    cwd = __CWD__.get()
+    return os.getcwd() if cwd is None else cwd
+
+def abspath(*paths):
+    """ Absolute path relative to the logical working directory """
+    return path.normpath(path.join(getcwd(), *paths))
+
 def make_dirs(dir_path):
-    os.makedirs(dir_path, exist_ok=True)
+    os.makedirs(abspath(dir_path), exist_ok=True)
 
-def shell_exec(*commands, check_error=True):
-    str_com = " ".join([str(c) for c in commands])
-    bash_logger.debug(str_com)
-    code = os.system(str_com)
-    if check_error and (code != 0):
+class ExecResult:
+    def __init__(self, argv, code, output, duration):
+        self.argv = argv
+        self.code = code
+        # merged stdout and stderr, None if output is not captured
+        self.output = output
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.code == 0
+
+    def __repr__(self):
+        return "ExecResult(code={}, duration={:.3f}s, argv={})".format(
+            self.code, self.duration, self.argv)
+
+# seconds to wait for the background grandchildren, which hold the
+#   output pipe open after the command exits.
+PIPE_HELD_TIMEOUT = 0.5
+
+def pipe_held(pipe) -> bool:
+    """ Whether the pipe is open without pending data, since EOF is
+            readable once all the writers are closed.
+    """
+    readable, _, _ = select.select([pipe], [], [], 0)
+    return not readable
+
+def drain(reader, pipe):
+    """ Wait for reader to read pipe until EOF after the command
+            exits, or at most PIPE_HELD_TIMEOUT if the pipe is held.
+    """
+    deadline = None
+    while reader.is_alive():
+        if deadline is None and pipe_held(pipe):
+            deadline = time.monotonic() + PIPE_HELD_TIMEOUT
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        reader.join(0.01)
+
+def run(argv, shell=False, cwd=None, env=None, timeout=None,
+        check=True, capture=False, stream=True) -> ExecResult:
+    """ Execute command and wait for the result
+
+        argv: list of command arguments, or the command string if
+            shell is enabled, which is needed for pipes and globs.
+        env: environments updated over the current process.
+        timeout: seconds to kill the command, and RuntimeError is
+            raised regardless of check flag.
+        check: raise RuntimeError if the exit code is not zero.
+        capture: collect output into the result.
+        stream: write output into `bash` logger line by line.
+
+        The command inherits the standard io if neither capture nor
+            stream is enabled, which is needed for interactive
+            commands, like apt prompts and netcat.
+    """
+    if shell:
+        str_com = argv if isinstance(argv, str) else \
+            " ".join([str(c) for c in argv])
+        argv = ["/bin/sh", "-c", str_com]
+    else:
+        argv = [str(c) for c in argv]
+        str_com = " ".join([shlex.quote(c) for c in argv])
+
+    if env is not None:
+        env = dict(os.environ, **{k: str(v) for k, v in env.items()})
+
+    bash_logger.debug(str_com if cwd is None else \
+        "(cd {} && {})".format(cwd, str_com))
+    piped = capture or stream
+    lines = []
+
+    def _read_output(stdout):
+        for line in stdout:
+            line = line.rstrip("\n")
+            if stream:
+                bash_logger.info(line)
+            if capture:
+                lines.append(line)
+
+    cwd = __CWD__.get() if cwd is None else abspath(cwd)
+    with trace.span(str_com, cat="shell", cwd=cwd or os.getcwd()) as targs:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            argv, cwd=cwd, env=env,
+            stdout=subprocess.PIPE if piped else None,
+            stderr=subprocess.STDOUT if piped else None,
+            text=piped, errors="replace" if piped else None)
+
+        reader = None
+        if piped:
+            reader = threading.Thread(
+                target=_read_output, args=(proc.stdout,),
+                name="bash-output", daemon=True)
+            reader.start()
+
+        killed = False
+        try:
+            code = proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            killed = True
+            raise RuntimeError("command execute timeout after {}s: {}".format(
+                timeout, str_com))
+        except BaseException:
+            killed = True
+            raise
+        finally:
+            if killed:
+                proc.kill()
+                proc.wait()
+            if reader is not None:
+                drain(reader, proc.stdout)
+            targs["code"] = proc.returncode
+
+    result = ExecResult(
+        argv, code,
+        "\n".join(list(lines)) if capture else None,
+        time.perf_counter() - start)
+    bash_logger.debug("exit code {} in {:.3f}s".format(
+        code, result.duration))
+    if check and (code != 0):
         raise RuntimeError(
-            "command execute terminated: {}".format(str_com))
-    return code
+            "command execute terminated with code {}: {}".format(
+                code, str_com))
+    return result
+
+def shell_exec(*commands, check_error=True):
+    """ Compatible wrapper of `run`, executes joined commands in shell
+        with the standard io inherited.
+    """
+    return run(commands, shell=True, check=check_error,
+               stream=False).code
+
+def check_output(*commands) -> bytes:
+    return run(commands, capture=True, stream=False).output.encode()
+
+class JobPool:
+    """ Execute commands concurrently with bounded workers
+
+        The output of each job is captured and written into `bash`
+            logger in the submission order, so that the logs of
+            different commands are never interleaved.
+
+        fail_fast: stop the pending jobs and raise at the first
+            failed job, otherwise all the jobs are executed and the
+            failures are raised together after all finished.
+
+        >>> with base.JobPool(jobs=4) as pool:
+        >>>     for f in files:
+        >>>         pool.submit(["rsync", f, dest])
+    """
+    def __init__(self, jobs=None, fail_fast=True, timeout=None):
+        self._jobs = jobs or os.cpu_count() or 1
+        self._fail_fast = fail_fast
+        self._timeout = timeout
+        self._failed = threading.Event()
+        self._futures = []
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self._jobs, thread_name_prefix="job")
+
+    def _run(self, argv, kw):
+        if self._fail_fast and self._failed.is_set():
+            return None
+        kw.setdefault("timeout", self._timeout)
+        try:
+            result = run(argv, capture=True, stream=False,
+                         check=False, **kw)
+        except Exception:
+            self._failed.set()
+            raise
+        if not result.ok:
+            self._failed.set()
+        return result
+
+    def submit(self, argv, **kw) -> futures.Future:
+        """ Submit command with the arguments of `run` """
+        # jobs inherit the context, like working directory
+        future = self._executor.submit(
+            contextvars.copy_context().run, self._run, argv, kw)
+        self._futures.append((argv, future))
+        return future
+
+    def wait(self):
+        """ Wait for all the submitted jobs, return the results """
+        results, errors = [], []
+        try:
+            for argv, future in self._futures:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    result = None
+                else:
+                    if result is None:
+                        # skipped since previous job failed
+                        continue
+
+                    for line in result.output.splitlines():
+                        bash_logger.info(line)
+                    if not result.ok:
+                        errors.append(
+                            "command execute terminated with code {}: {}".format(
+                                result.code, " ".join(result.argv)))
+
+                results.append(result)
+                if errors and self._fail_fast:
+                    break
+        finally:
+            self._futures.clear()
+            self._executor.shutdown(cancel_futures=bool(errors))
+
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return results
+
+    def __enter__(self):
+        return self
 
-def check_output(*commands):
-    return subprocess.check_output(commands, stderr=subprocess.STDOUT)
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.wait()
+        else:
+            self._failed.set()
+            self._executor.shutdown(cancel_futures=True)
 
 class DirEntry:
     def __init__(self, target_dir):
-        self._curr_dir = os.getcwd()
-        self._tar_dir = target_dir
+        self._tar_dir = abspath(target_dir)
+        self._token = None
 
     def __enter__(self):
         bash_logger.debug("cd {}".format(self._tar_dir))
-        os.chdir(self._tar_dir)
+        self._token = __CWD__.set(self._tar_dir)
+        return self._tar_dir
 
     def __exit__(self, *args):
-        bash_logger.debug("cd {}".format(self._curr_dir))
-        os.chdir(self._curr_dir)
+        __CWD__.reset(self._token)
+        bash_logger.debug("cd {}".format(getcwd()))
 
-# using with python `with` primitive enter block
+# using with python `with` primitive enter block, the process
+#   working directory is never changed, use `abspath` for files
+#   and `run` for commands.
 def enter(target_dir, create=False):
     if create:
         make_dirs(target_dir)
@@ -0,0 +1,226 @@
+""" Memoization Cache
+
+    Memoize the results of environment probes, like `lsb_release` and
+    `gcc -dumpversion`, which rarely change but cost a fork and exec
+    on every invocation. The results are kept in a small in-process
+    LRU, and stored on disk under `base.CACHE_ROOT` to be shared
+    between invocations.
+
+    The key is derived from function arguments and the declared
+    environments, and the entry expires after ttl seconds.
+
+    >>> @cache.memoize(ttl=3600, env=["PATH"])
+    >>> def gcc_version(binary):
+    >>>     ...
+    >>> gcc_version.invalidate("g++")
+"""
+import os
+import time
+import shutil
+import pickle
+import hashlib
+import logging
+import threading
+import functools
+from os import path
+from collections import OrderedDict
+
+from . import base, cmd
+
+logger = logging.getLogger("cache")
+
+MEMO_ROOT = path.join(base.CACHE_ROOT, "memo")
+# probe results are valid for one day by default
+PROBE_TTL = 24 * 3600
+
+__MEMOS__ = {}
+
+class LRU:
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class Memo:
+    """ Two level store of memoized function, the entry is tuple of
+            (expire timestamp or None, value).
+    """
+    def __init__(self, name, ttl=None, env=[], maxsize=128, persist=True):
+        self.name = name
+        self.ttl = ttl
+        self.env = sorted(env)
+        self.persist = persist
+        self._lru = LRU(maxsize)
+
+    def key(self, args, kw) -> str:
+        env = [(k, os.environ.get(k, None)) for k in self.env]
+        data = repr((args, sorted(kw.items()), env))
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def file_path(self, key):
+        return path.join(MEMO_ROOT, self.name, key)
+
+    def load(self, key):
+        entry = self._lru.get(key)
+        if entry is None and self.persist:
+            entry = self.load_file(key)
+            if entry is not None:
+                self._lru.put(key, entry)
+
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.time():
+            logger.debug("{} entry {} is expired".format(self.name, key))
+            self.invalidate(key)
+            return None
+        return entry
+
+    def load_file(self, key):
+        file_path = self.file_path(key)
+        if not path.exists(file_path):
+            return None
+
+        try:
+            with open(file_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.debug("load {} failed: {}".format(file_path, e))
+            return None
+
+    def dump(self, key, value):
+        expire = None if self.ttl is None else time.time() + self.ttl
+        entry = (expire, value)
+        self._lru.put(key, entry)
+        if not self.persist:
+            return
+
+        file_path = self.file_path(key)
+        tmp_file = "{}.{}".format(file_path, os.getpid())
+        try:
+            os.makedirs(path.dirname(file_path), exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp_file, file_path)
+        except Exception as e:
+            logger.debug("skip dump {}: {}".format(file_path, e))
+            if path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def invalidate(self, key=None):
+        """ Remove the entry of key, or all entries if key is None """
+        if key is None:
+            self._lru.clear()
+            shutil.rmtree(path.join(MEMO_ROOT, self.name),
+                          ignore_errors=True)
+            return
+
+        self._lru.pop(key)
+        if path.exists(self.file_path(key)):
+            os.remove(self.file_path(key))
+
+def memoize(ttl=None, env=[], maxsize=128, persist=True, name=None):
+    """ Memoize function results in memory and on disk
+
+        ttl: seconds the result is valid, never expire if None.
+        env: environment names that the result depends on.
+        persist: store the result on disk, the arguments and result
+            should be picklable.
+        name: cache namespace, function qualified name by default.
+    """
+    def _func(func):
+        memo = Memo(name or "{}.{}".format(func.__module__, func.__qualname__),
+                    ttl=ttl, env=env, maxsize=maxsize, persist=persist)
+        __MEMOS__[memo.name] = memo
+
+        @functools.wraps(func)
+        def _memoize(*args, **kw):
+            key = memo.key(args, kw)
+            entry = memo.load(key)
+            if entry is not None:
+                return entry[1]
+
+            value = func(*args, **kw)
+            memo.dump(key, value)
+            return value
+
+        _memoize.memo = memo
+        _memoize.invalidate = lambda *args, **kw: \
+            memo.invalidate(memo.key(args, kw))
+        _memoize.clear = memo.invalidate
+        return _memoize
+    return _func
+
+@memoize(ttl=PROBE_TTL, env=["PATH"], name="probe")
+def probe(*argv) -> str:
+    """ Stripped output of environment probe command """
+    return base.run(list(argv), capture=True, stream=False).output.strip()
+
+def invalidate(*names):
+    """ Remove cached entries of names, or all if names are empty """
+    if not names:
+        for memo in __MEMOS__.values():
+            memo._lru.clear()
+        shutil.rmtree(MEMO_ROOT, ignore_errors=True)
+        return
+
+    for name in names:
+        if name in __MEMOS__:
+            __MEMOS__[name].invalidate()
+        else:
+            shutil.rmtree(path.join(MEMO_ROOT, name), ignore_errors=True)
+
+@cmd.option("--clear", metavar="NAME",
+            nargs="*", default=None,
+            help="clear cache of names, or all if no name is given")
+@cmd.module("cache", as_main=True,
+            help="memoization cache tool",
+            description="""
+Memoization Cache Tool
+
+  List the cached namespaces and entry numbers under
+    {}, or clear the caches.
+""".format(MEMO_ROOT))
+def cache_main(args):
+    if args.clear is not None:
+        invalidate(*args.clear)
+        logger.info("cache cleared: {}".format(
+            " ".join(args.clear) or "all"))
+        return
+
+    if not path.exists(MEMO_ROOT):
+        return
+    for name in sorted(os.listdir(MEMO_ROOT)):
+        logger.info("%-40s %d entries" % (
+            name, len(os.listdir(path.join(MEMO_ROOT, name)))))
+
+if __name__ == "__main__":
+    from . import log
+
+    log.Init(log.DEBUG)
+    for _ in range(3):
+        start = time.perf_counter()
+        probe("uname", "-r")
+        logger.info("probe cost {:.6f}s".format(
+            time.perf_counter() - start))
@@ -0,0 +1,87 @@
+""" Thin Client of BBCode Command Server
+
+    The client forwards the command line arguments, working directory
+    and environments into the prewarmed server started via
+    `script.py server`, and the standard io file descriptors are
+    passed along with the request, so that the forked worker writes
+    into client's terminal directly. The exit code of worker is sent
+    back to client at last.
+
+    This module should only depend on the python standard library,
+    since it's imported before any other module in the main script.
+"""
+import os
+import sys
+import json
+import signal
+import socket
+from os import path
+
+CACHE_ROOT = path.join(
+    os.environ.get("XDG_CACHE_HOME", path.expanduser("~/.cache")),
+    "bbcode")
+SOCKET_FILE = os.environ.get(
+    "BBCODE_SOCKET", path.join(CACHE_ROOT, "server.sock"))
+
+def send_message(sock, **kw):
+    sock.sendall((json.dumps(kw) + "\n").encode())
+
+def forward(argv, socket_file=SOCKET_FILE):
+    """ Run command in server, return None if server is unavailable
+
+        The server may reply stale if the sources have been changed
+            since it's started, and the command should run locally.
+    """
+    if not socket_file or not path.exists(socket_file):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except OSError:
+        sock.close()
+        return None
+
+    request = json.dumps({
+        "argv": list(argv),
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+    }) + "\n"
+
+    def _forward_signal(signo, _frame=None):
+        if worker_pid is not None:
+            os.kill(worker_pid, signo)
+
+    worker_pid, exit_code = None, None
+    with sock, sock.makefile("r") as reader:
+        try:
+            socket.send_fds(sock, [request.encode()], [
+                sys.stdin.fileno(),
+                sys.stdout.fileno(),
+                sys.stderr.fileno()])
+        except OSError:
+            # server is shutting down, run locally
+            return None
+
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if message.get("stale", False):
+                    return None
+
+                if "pid" in message:
+                    worker_pid = message["pid"]
+                    for sig in ('TERM', 'HUP', 'INT'):
+                        signal.signal(
+                            getattr(signal, 'SIG'+sig),
+                            _forward_signal)
+
+                if "exit" in message:
+                    exit_code = message["exit"]
+                    break
+        except OSError:
+            if worker_pid is None:
+                return None
+
+    # worker is terminated without exit code
+    return 255 if exit_code is None else exit_code
@@ -16,10 +16,10 @@
     @func module: Module main entry function, the releated function
         will trigger after the command line set name.
 
-        One notable thing to be indicated is that the dependencies
-        between modules should not contains cycle, or will raise
-        runtime error. The dependent module's options will be treated
-        as group reference, and group options will be copied into
+        One notable thing to be indicated is that the modules in
+        a dependency cycle share all the groups of each other. The
+        dependent module's options will be treated as group
+        reference, and public group options will be shared with
         current module's group options.
 
         @param refs: List of module string, auto combine module options
@@ -27,6 +27,8 @@
     @func group: Group module wrapper function.
     @func option: Wrapper function by the `add_argument` in
         `argparse.ArgumentParser`.
+    @func lazy_func: Declare module interface without importing the
+        implementation, which will be imported at invocation.
 
     Notices: The main entry must be zero or one instance, or will raise
         error.
@@ -63,19 +65,27 @@
 
 from __future__ import annotations
 
-from typing import Sequence, Dict, Set
+from typing import Sequence, Dict
 from typing import Callable
 
-import copy
+import os
+import sys
 import json
+import pickle
+import hashlib
 import logging
+import importlib
+import functools
+from os import path
 from enum import Enum
 
 import argparse
 
+from . import trace
+
 __all__ = [
     "PUBLIC", "PRIVATE",
-    "module", "group", "option",
+    "module", "group", "option", "lazy_func",
     "Run"]
 
 class CmdName:
@@ -85,24 +95,52 @@ class CmdName:
         2. Array for module names, aka ["cmd", "test"]
         3. Group related name, aka "cmd-test", always with prefix:"--"
         4. Argument name parsed from command line, aka "cmd_test"
+
+        Names are interned and the formats are computed once, so
+            the same name always refers to the same instance.
     """
+    __slots__ = ("name", "mod_array", "mod_prefix_arr",
+                 "mod_name", "cmd_name", "arg_name", "_hash")
+    __INTERNED__ : Dict[str, CmdName] = {}
+
+    def __new__(cls, log_name : str):
+        cmd_name = cls.__INTERNED__.get(log_name, None)
+        if cmd_name is not None:
+            return cmd_name
 
-    def __init__(self, log_name : str):
         assert "-" not in log_name, log_name
         assert "_" not in log_name, log_name
-        self.name = log_name
+        cmd_name = super(CmdName, cls).__new__(cls)
+        cmd_name.name = log_name
+        cmd_name.mod_array = tuple([n for n in log_name.split(".") if n])
+        cmd_name.mod_prefix_arr = tuple([
+            ".".join(cmd_name.mod_array[:i+1]) \
+            for i in range(len(cmd_name.mod_array))])
+        cmd_name.mod_name = log_name.replace(".", " ")
+        cmd_name.cmd_name = "--" + log_name.replace(".", "-")
+        cmd_name.arg_name = log_name.replace(".", "_")
+        cmd_name._hash = hash(log_name)
+
+        cls.__INTERNED__[log_name] = cmd_name
+        return cmd_name
 
     def __repr__(self):
         return self.name
 
+    # keep interned after unpickle
+    def __reduce__(self):
+        return (CmdName, (self.name,))
+
     # hashable type, can be used at dict type
     def __hash__(self):
-        return hash(self.name)
+        return self._hash
 
     def __eq__(self, other : CmdName):
+        if isinstance(other, CmdName):
+            return other is self
         if isinstance(other, str):
-            other = CmdName(other)
-        return other.name == self.name
+            return other == self.name
+        return NotImplemented
 
     @staticmethod
     def from_mod_array(mod_arr : Sequence[str]) -> CmdName:
@@ -117,31 +155,55 @@ class CmdName:
         return CmdName(arg_name.replace("_", "."))
 
     @property
-    def mod_array(self):
-        return [n for n in self.name.split(".") if n]
+    def depth(self):
+        return len(self.mod_array)
 
-    @property
-    def mod_prefix_arr(self):
-        prefix_arr = []
-        for i in range(len(self.mod_array)):
-            prefix_arr.append(".".join(self.mod_array[:i+1]))
-        return prefix_arr
+    @staticmethod
+    def topo_sort(cmd_names : Sequence[CmdName]) -> Sequence[CmdName]:
+        return sorted(cmd_names, key=lambda x : x.depth, reverse=True)
 
-    @property
-    def mod_name(self):
-        return self.name.replace(".", " ")
+class CmdNode:
+    """ Prefix trie node of the module tree
 
-    @property
-    def cmd_name(self):
-        return "--" + self.name.replace(".", "-")
+        The node refers to resolved module entry, and the parser
+            created for the module.
+    """
+    __slots__ = ("name", "entry", "children", "parser", "sub_parser")
 
-    @property
-    def arg_name(self):
-        return self.name.replace(".", "_")
+    def __init__(self, name : CmdName):
+        self.name = name
+        self.entry : ModEntry = None
+        self.children : Dict[str, CmdNode] = {}
+        self.parser : argparse.ArgumentParser = None
+        self.sub_parser = None
 
-    @staticmethod
-    def topo_sort(cmd_names : Sequence[CmdName]) -> Sequence[CmdName]:
-        return sorted(cmd_names, key=lambda x : len(x.name), reverse=True)
+    def __repr__(self):
+        return "<CmdNode %s>" % self.name
+
+    def insert(self, name : CmdName) -> CmdNode:
+        node = self
+        for mod_name, prefix in zip(name.mod_array, name.mod_prefix_arr):
+            if mod_name not in node.children:
+                node.children[mod_name] = CmdNode(CmdName(prefix))
+            node = node.children[mod_name]
+        return node
+
+    def find(self, name : CmdName) -> CmdNode:
+        node = self
+        for mod_name in name.mod_array:
+            node = node.children.get(mod_name, None)
+            if node is None:
+                return None
+        return node
+
+    def walk(self):
+        """ Pre-order traverse of (parent, child) node pairs """
+        stack = [(self, c) for c in reversed(self.children.values())]
+        while stack:
+            parent, node = stack.pop()
+            yield parent, node
+            stack.extend([(node, c) \
+                for c in reversed(node.children.values())])
 
 PUBLIC = 0
 PRIVATE = 1
@@ -180,7 +242,39 @@ class CmdFunction:
     def __call__(self, *args, **kw):
         if self.func is None:
             raise RuntimeError("null module function")
-        return self.func(*args, **kw)
+        if isinstance(self.func, str):
+            self.func = CmdFunction.import_func(self.func)
+            # the module attribute is the CmdFunction of decorators
+            while isinstance(self.func, CmdFunction):
+                self.func = self.func.func
+        if not trace.enabled():
+            return self.func(*args, **kw)
+
+        func_name = getattr(self.func, "__qualname__", str(self.func))
+        with trace.span(func_name, cat="func"):
+            return self.func(*args, **kw)
+
+    # serialize function as import path for manifest
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if callable(self.func):
+            state["func"] = CmdFunction.func_path(self.func)
+        return state
+
+    @staticmethod
+    def func_path(func) -> str:
+        if "<locals>" in func.__qualname__:
+            raise pickle.PicklingError(
+                "cannot refer to local function: " + func.__qualname__)
+        return func.__module__ + ":" + func.__qualname__
+
+    @staticmethod
+    def import_func(func_path : str):
+        mod_name, func_name = func_path.split(":")
+        func = importlib.import_module(mod_name)
+        for name in func_name.split("."):
+            func = getattr(func, name)
+        return func
 
     def wrapper(self, func):
         if self.func is not None:
@@ -204,6 +298,7 @@ class GroupEntry:
         self.params : CmdOption = CmdOption()
         self.func : CmdFunction = CmdFunction(
             self.group_option(PUBLIC))
+        self._public : GroupEntry = None
 
     def register_parser(self, *args, **kw):
         self.params.args.extend(args)
@@ -232,9 +327,21 @@ class GroupEntry:
         return self.options[-1]
 
     def public_group_entry(self) -> GroupEntry:
-        gentry = GroupEntry(self.name)
-        gentry.options = [opt for opt in self.options \
+        """ Public view of the group, created once and shared by
+                all the referrers, so the view should not be modified.
+        """
+        if self._public is None:
+            self._public = self.create_public_entry()
+        return self._public
+
+    def create_public_entry(self) -> GroupEntry:
+        options = [opt for opt in self.options \
             if opt.permission == PUBLIC]
+        if len(options) == len(self.options):
+            return self
+
+        gentry = GroupEntry(self.name)
+        gentry.options = options
         gentry.params = self.params
         gentry.func = self.func
         return gentry
@@ -242,8 +349,9 @@ class GroupEntry:
 class ModEntry(GroupEntry):
     def __init__(self, name : CmdName):
         super(ModEntry, self).__init__(name)
-        self.references : Set[str] = set()
-        self.groups : Dict[str, GroupEntry] = {}
+        # ordered references to keep group order deterministic
+        self.references : Dict[CmdName, None] = {}
+        self.groups : Dict[CmdName, GroupEntry] = {}
 
     def to_string(self, new_line = True):
         split_str = "\n\t" if new_line else " "
@@ -253,13 +361,20 @@ class ModEntry(GroupEntry):
         ser += "groups=[%s]" % gser
         return ser
 
+    def add_references(self, refs : Sequence[str]):
+        for ref in refs:
+            self.references[CmdName(ref)] = None
+
     def group_entry(self, group_name : CmdName) -> GroupEntry:
         if group_name not in self.groups:
             self.groups[group_name] = GroupEntry(group_name)
         return self.groups[group_name]
 
-    def public_group_entry(self) -> GroupEntry:
-        gentry = super(ModEntry, self).public_group_entry()
+    def create_public_entry(self) -> GroupEntry:
+        gentry = GroupEntry(self.name)
+        gentry.options = [opt for opt in self.options \
+            if opt.permission == PUBLIC]
+        gentry.func = self.func
 
         if not self.func.empty():
             gopt = GroupOption(self.func.options.permission)
@@ -269,8 +384,8 @@ class ModEntry(GroupEntry):
                 help="enable module " + self.name.mod_name)
             gentry.options.insert(0, gopt)
 
-        gentry.params = copy.deepcopy(self.params)
-        gentry.params.args.insert(0, self.name.mod_name)
+        gentry.params = CmdOption(
+            self.name.mod_name, *self.params.args, **self.params.kw)
         # group has no help option
         gentry.params.kw.pop("help", None)
         return gentry
@@ -288,7 +403,12 @@ class ModEntry(GroupEntry):
 
 class CmdStorage:
     STORE : Dict[CmdName, ModEntry] = {}
-    PARSERS = {}
+    # resolved modules with main entry, filled via `resolve`
+    MODULES : Dict[CmdName, ModEntry] = {}
+    # resolved prepare function and global groups
+    PREPARE = None
+    # module tree built from MODULES, filled via `init_parsers`
+    TREE : CmdNode = None
     GLOBAL_NAME = "global.options"
 
     @staticmethod
@@ -303,52 +423,98 @@ class CmdStorage:
         return CmdStorage.STORE[mod_name]
 
     @staticmethod
-    def refer_analysis(entry : ModEntry, ref_path = []):
-        # quick pruning for reference analisis 
-        if getattr(entry, "visited", None):
-            return
-
-        refers = {n: CmdStorage.get_entry(n) for n in entry.references}
-
-        def _trigger_cycle_path(ref_name):
-            common_groups = {}
-
-            ref_path.append(ref_name)
-            start = ref_path.index(ref_name)
-            for ref_name in ref_path[start:-1]:
-                ref_entry = CmdStorage.get_entry(ref_name)
-                # TODO: may cause undeterministic behavior, since
-                #   group names may be duplicated.
-                common_groups.update(ref_entry.as_groups())
-
-            for idx, ref_name in enumerate(ref_path[start:-1]):
-                ref_entry = CmdStorage.get_entry(ref_name)
-                # remove dependency reference in ref_path
-                ref_entry.references.remove(ref_path[start+idx+1])
-                ref_entry.update_groups(common_groups)
+    def strong_components() -> Sequence[Sequence[ModEntry]]:
+        """ Tarjan's strongly connected components of references
 
-            ref_path.pop(-1)
+            The components are returned in reverse topological order,
+                that is the referred modules are ahead of referrers,
+                and the members are sorted by register order.
+        """
+        for entry in list(CmdStorage.STORE.values()):
+            for ref_name in entry.references:
+                CmdStorage.get_entry(ref_name)
 
-        ref_path.append(entry.name)
+        order = {name: idx for idx, name \
+            in enumerate(CmdStorage.STORE.keys())}
+        index, lowlink = {}, {}
+        stack, on_stack = [], set()
+        components = []
 
-        for ref_name, ref_entry in refers.items():
-            if ref_name in ref_path:
-                _trigger_cycle_path(ref_name)
+        for root in CmdStorage.STORE.keys():
+            if root in index:
                 continue
-            CmdStorage.refer_analysis(ref_entry, ref_path)
 
-        # remove refs and update current entry's groups
-        for ref_name, ref_entry in refers.items():
-            entry.groups[ref_name] = ref_entry.public_group_entry()
-            for k, v in ref_entry.groups.items():
-                if k not in entry.groups:
-                    entry.groups[k] = v.public_group_entry()
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(CmdStorage.STORE[root].references))]
+            while work:
+                name, refs = work[-1]
+                ref_name = next(refs, None)
+                if ref_name is not None:
+                    if ref_name not in index:
+                        index[ref_name] = lowlink[ref_name] = len(index)
+                        stack.append(ref_name)
+                        on_stack.add(ref_name)
+                        work.append((ref_name, iter(
+                            CmdStorage.STORE[ref_name].references)))
+                    elif ref_name in on_stack:
+                        lowlink[name] = min(lowlink[name], index[ref_name])
+                    continue
 
-        if entry.name in entry.groups:
-            del entry.groups[entry.name]
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] != index[name]:
+                    continue
 
-        setattr(entry, "visited", True)
-        ref_path.remove(entry.name)
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(CmdStorage.STORE[member])
+                    if member == name:
+                        break
+                component.sort(key=lambda e: order[e.name])
+                components.append(component)
+        return components
+
+    @staticmethod
+    def resolve_references():
+        """ Merge the referred modules' public groups into modules
+
+            Each strongly connected component is merged once, and
+                the modules in a reference cycle share the groups of
+                each other. The public groups are shared objects
+                instead of copies.
+        """
+        for component in CmdStorage.strong_components():
+            names = set([e.name for e in component])
+            is_cycle = len(component) > 1 or \
+                component[0].name in component[0].references
+
+            merged = {}
+            for entry in component:
+                if is_cycle:
+                    for k, v in entry.as_groups().items():
+                        merged.setdefault(k, v)
+
+                for ref_name in entry.references:
+                    if ref_name in names:
+                        continue
+                    ref_entry = CmdStorage.STORE[ref_name]
+                    merged.setdefault(
+                        ref_name, ref_entry.public_group_entry())
+                    for k, v in ref_entry.groups.items():
+                        merged.setdefault(k, v.public_group_entry())
+
+            for entry in component:
+                groups = dict(entry.groups)
+                for k, v in merged.items():
+                    if k != entry.name and k not in groups:
+                        groups[k] = v
+                entry.groups = groups
 
     @staticmethod
     def init_parser(parser : argparse.ArgumentParser,
@@ -390,11 +556,7 @@ class CmdStorage:
                         entry.name, e))
                     raise e
 
-        def _func(args):
-            # invoke prepare function
-            if not pre_func.empty():
-                pre_func(args)
-
+        def _dispatch(args):
             for group in entry.groups.values():
                 if group.func.empty():
                     continue
@@ -407,47 +569,76 @@ class CmdStorage:
             raise RuntimeError(
                 "can not find module [" + entry.name.mod_name + \
                 "] main function to run")
-        parser.set_defaults(func=_func)
+
+        def _func(args):
+            # invoke prepare function
+            if not pre_func.empty():
+                pre_func(args)
+
+            with trace.span(entry.name.name or "main", cat="cmd"):
+                return _dispatch(args)
+        # module name is exposed for global prepare function
+        parser.set_defaults(func=_func, cmd_module=entry.name.name)
 
     @staticmethod
-    def init_parser_object(parser_object, mod_name, entry, pre_func):
-        logger = logging.getLogger("cmd.parser")
+    def init_parser_object(parent : CmdNode, node : CmdNode, pre_func,
+                           lazy = False):
+        """ Add module sub parser into parent node
 
-        if "sub_parser" not in parser_object:
-            parser_object["sub_parser"] = \
-                parser_object["parser"].add_subparsers(
-                    title = "COMMAND",
-                    description = "supportive sub commands")
+            The lazy parser only shows in the parent's help and
+                choices, without any options and main function.
+        """
+        logger = logging.getLogger("cmd.parser")
 
+        if parent.sub_parser is None:
+            parent.sub_parser = parent.parser.add_subparsers(
+                title = "COMMAND",
+                description = "supportive sub commands")
 
+        entry = node.entry
         entry.params.kw.setdefault(
             "formatter_class",
             argparse.RawDescriptionHelpFormatter)
 
         try:
-            mod_parser = parser_object["sub_parser"].add_parser(
-                mod_name, *entry.params.args, **entry.params.kw)
+            node.parser = parent.sub_parser.add_parser(
+                node.name.mod_array[-1],
+                *entry.params.args, **entry.params.kw)
         except Exception as e:
             logger.error("module({}): {}".format(
                 entry.name, e))
             raise e
 
-        CmdStorage.init_parser(mod_parser, entry, pre_func)
-        parser_object[mod_name] = { "parser": mod_parser, }
-        return mod_parser
+        if not lazy:
+            CmdStorage.init_parser(node.parser, entry, pre_func)
+        return node.parser
 
     @staticmethod
-    def init_parsers() -> argparse.ArgumentParser:
+    def get_module(mod_name) -> ModEntry:
+        if isinstance(mod_name, str):
+            mod_name = CmdName(mod_name)
 
-        for entry in list(CmdStorage.STORE.values()):
-            CmdStorage.refer_analysis(entry)
+        if mod_name not in CmdStorage.MODULES:
+            CmdStorage.MODULES[mod_name] = ModEntry(mod_name)
+        return CmdStorage.MODULES[mod_name]
+
+    @staticmethod
+    def resolve():
+        """ Resolve module references and prune the modules without
+                main entry, the result is stored in `MODULES` and
+                `PREPARE`, and the function is invoked only once.
+        """
+        if CmdStorage.PREPARE is not None:
+            return
+
+        CmdStorage.resolve_references()
 
         pre_entry = CmdStorage.get_entry(CmdStorage.GLOBAL_NAME)
         CmdStorage.STORE.pop(CmdStorage.GLOBAL_NAME)
-        pre_func = pre_entry.func.move()
-        pre_groups = pre_entry.as_groups()
+        CmdStorage.PREPARE = (pre_entry.func.move(), pre_entry.as_groups())
 
         # remove unuseful module path
+        unuseful = set()
         for name in CmdName.topo_sort(CmdStorage.STORE.keys()):
             entry = CmdStorage.STORE[name]
             if getattr(entry, "has_main_entry", None):
@@ -463,10 +654,212 @@ class CmdStorage:
                         setattr(CmdStorage.get_entry(mod_name),
                                 "has_main_entry", True)
             else:
-                del CmdStorage.STORE[name]
+                unuseful.add(name)
+
+        CmdStorage.MODULES = {k: v for k, v in CmdStorage.STORE.items() \
+            if k not in unuseful}
+
+    @staticmethod
+    def manifest_key(sources : Sequence[str], packages = [],
+                     env : Sequence[str] = []) -> str:
+        """ Source key computed from the `.py` files' mtime and size,
+                and the environments read by the option defaults.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(sys.version.encode())
+        hasher.update(repr(packages).encode())
+        hasher.update(repr(
+            [(k, os.environ.get(k, None)) for k in sorted(env)]).encode())
+
+        for source in sources:
+            files = [source]
+            if path.isdir(source):
+                files = []
+                for root, dirs, names in os.walk(source):
+                    dirs.sort()
+                    files.extend([path.join(root, n) \
+                        for n in sorted(names) if n.endswith(".py")])
+
+            for fpath in files:
+                stat = os.stat(fpath)
+                hasher.update("{}:{}:{};".format(
+                    fpath, stat.st_mtime_ns, stat.st_size).encode())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def load_manifest(manifest : str, key : str) -> bool:
+        logger = logging.getLogger("cmd.manifest")
+        if not path.exists(manifest):
+            return False
+
+        try:
+            with open(manifest, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.debug("load manifest({}) failed: {}".format(
+                manifest, e))
+            return False
+
+        if data.get("key", None) != key:
+            logger.debug("manifest({}) is outdated".format(manifest))
+            return False
+
+        CmdStorage.MODULES = data["modules"]
+        CmdStorage.PREPARE = data["prepare"]
+        return True
+
+    @staticmethod
+    def dump_manifest(manifest : str, key : str):
+        logger = logging.getLogger("cmd.manifest")
+        data = {
+            "key": key,
+            "modules": CmdStorage.MODULES,
+            "prepare": CmdStorage.PREPARE,
+        }
+
+        tmp_file = "{}.{}".format(manifest, os.getpid())
+        try:
+            os.makedirs(path.dirname(manifest), exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                pickle.dump(data, f)
+            os.replace(tmp_file, manifest)
+        except Exception as e:
+            logger.debug("skip dump manifest({}): {}".format(manifest, e))
+            if path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    @staticmethod
+    def load(packages : Sequence[str] = [],
+             manifest : str = None,
+             sources : Sequence[str] = [],
+             env : Sequence[str] = []):
+        """ Import module packages and resolve the registry
+
+            The resolved registry is cached in the `manifest` file,
+                which is keyed by the `sources` files. The packages
+                import and resolve process will be skipped if the
+                manifest is up to date, and the module functions are
+                imported by path when invoked.
+
+            The option defaults are frozen in the manifest, so the
+                `env` names read by the defaults are keyed as well.
+        """
+        if CmdStorage.PREPARE is not None:
+            return
+
+        if manifest is not None:
+            key = CmdStorage.manifest_key(sources, packages, env)
+            if CmdStorage.load_manifest(manifest, key):
+                return
+
+        for package in packages:
+            importlib.import_module(package)
+        CmdStorage.resolve()
+
+        if manifest is not None:
+            CmdStorage.dump_manifest(manifest, key)
+
+    @staticmethod
+    def build_tree() -> CmdNode:
+        root = CmdNode(CmdName(""))
+        for name in CmdStorage.MODULES.keys():
+            root.insert(name)
+
+        # intermediate module path without registration
+        root.entry = CmdStorage.get_module(root.name)
+        for _, node in root.walk():
+            node.entry = CmdStorage.get_module(node.name)
+        return root
+
+    # actions without option values
+    FLAG_ACTIONS = ["store_true", "store_false", "store_const",
+                    "append_const", "count", "help", "version"]
+
+    @staticmethod
+    def value_options(entry : ModEntry, pre_groups) -> Dict[str, object]:
+        """ Option strings of module to nargs, 0 for the flags """
+        groups = list(entry.groups.values()) + list(pre_groups.values())
+        nargs = {"-h": 0, "--help": 0}
+        for gopts in [entry.options] + [g.options for g in groups]:
+            for gopt in gopts:
+                for opt in gopt.options:
+                    num = opt.kw.get("nargs", None)
+                    if opt.kw.get("action", None) in \
+                            CmdStorage.FLAG_ACTIONS:
+                        num = 0
+                    for name in opt.args:
+                        if name.startswith("-"):
+                            nargs[name] = num
+        return nargs
+
+    @staticmethod
+    def option_nargs(nargs, name, allow_abbrev=True):
+        """ nargs of option name, or of the unique long option with
+                the name as prefix, like argparse abbreviation.
+        """
+        if name in nargs:
+            return nargs[name]
+        if allow_abbrev and name.startswith("--"):
+            matches = [n for n in nargs if n.startswith(name)]
+            if len(matches) == 1:
+                return nargs[matches[0]]
+        return 0
+
+    @staticmethod
+    def resolve_path(argv : Sequence[str],
+                     pre_groups = {}) -> Sequence[CmdNode]:
+        """ Match the command line prefix against the module tree
+
+            Arguments not in the sub module names are skipped, since
+                they may be options or values of the parent module.
+                The option values are skipped as argparse consumes,
+                like `--control-socket ssh` or the abbreviated
+                `--control ssh`.
+        """
+        mod_path = []
+        node = CmdStorage.TREE
+        nargs = CmdStorage.value_options(node.entry, pre_groups)
+        abbrev = node.entry.params.kw.get("allow_abbrev", True)
+        # option values to skip, or -1 until the next option
+        skip = 0
+        for arg in argv:
+            if arg == "--":
+                break
+
+            if arg.startswith("-") and len(arg) > 1:
+                name, _, value = arg.partition("=")
+                num = 0 if value else \
+                    CmdStorage.option_nargs(nargs, name, abbrev)
+                skip = {None: 1, "?": 1, "*": -1, "+": -1}.get(num, num)
+                continue
+            if skip != 0:
+                skip = max(skip - 1, -1)
+                continue
+
+            if arg not in node.children:
+                continue
+            node = node.children[arg]
+            nargs = CmdStorage.value_options(node.entry, pre_groups)
+            abbrev = node.entry.params.kw.get("allow_abbrev", True)
+            mod_path.append(node)
+        return mod_path
+
+    @staticmethod
+    def init_parsers(argv = None) -> argparse.ArgumentParser:
+        """ Create the root parser and sub module parsers
+
+            All the parsers are constructed if `argv` is None or
+                there is no sub command in `argv`, aka `-h` at the
+                root, otherwise only the parsers along the invoked
+                module path are materialized, and the siblings are
+                created lazily for help usage.
+        """
+        CmdStorage.resolve()
+        pre_func, pre_groups = CmdStorage.PREPARE
+        CmdStorage.TREE = root = CmdStorage.build_tree()
 
         # init root parser descriptions
-        root_entry = CmdStorage.get_entry("")
+        root_entry = root.entry
         root_entry.params.kw.setdefault(
             "description",
             "bbcode helper script, implemented via python3")
@@ -477,39 +870,44 @@ class CmdStorage:
 
         logger = logging.getLogger("cmd.parser")
         try:
-            root_parser = argparse.ArgumentParser(
+            root.parser = argparse.ArgumentParser(
                 *root_entry.params.args, **root_entry.params.kw)
         except Exception as e:
             logger.error("module({}): {}".format(
                 root_entry.name, e))
             raise e
 
-        CmdStorage.init_parser(root_parser, root_entry, pre_func)
+        CmdStorage.init_parser(root.parser, root_entry, pre_func)
 
-        # set root parser object
-        CmdStorage.PARSERS["parser"] = root_parser
+        mod_path = [] if argv is None else \
+            CmdStorage.resolve_path(argv, pre_groups)
+        if mod_path:
+            CmdStorage.init_lazy_parsers(mod_path, pre_func, pre_groups)
+            return root.parser
 
-        for entry in list(CmdStorage.STORE.values()):
-            parser_object = CmdStorage.PARSERS
-            for mod_name, prefix in zip(
-                    entry.name.mod_array, entry.name.mod_prefix_arr):
-                if mod_name not in parser_object:
-                    mod_entry = CmdStorage.get_entry(prefix)
-                    mod_entry.update_groups(pre_groups)
-                    CmdStorage.init_parser_object(
-                        parser_object, mod_name,
-                        mod_entry, pre_func)
-                parser_object = parser_object[mod_name]
-        return root_parser
+        for parent, node in root.walk():
+            node.entry.update_groups(pre_groups)
+            CmdStorage.init_parser_object(parent, node, pre_func)
+        return root.parser
+
+    @staticmethod
+    def init_lazy_parsers(mod_path, pre_func, pre_groups):
+        parent = CmdStorage.TREE
+        for next_node in mod_path + [None]:
+            for node in parent.children.values():
+                lazy = node is not next_node
+                if not lazy:
+                    node.entry.update_groups(pre_groups)
+                CmdStorage.init_parser_object(
+                    parent, node, pre_func, lazy=lazy)
+            parent = next_node
 
     @staticmethod
     def get_parser(parser_path) -> argparse.ArgumentParser:
-        parser_object = CmdStorage.PARSERS
-        for mod_name in CmdName(parser_path).mod_array:
-            if mod_name not in parser_object:
-                raise RuntimeError("cannot find parser: " + parser_path)
-            parser_object = parser_object[mod_name]
-        return parser_object["parser"]
+        node = CmdStorage.TREE.find(CmdName(parser_path))
+        if node is None or node.parser is None:
+            raise RuntimeError("cannot find parser: " + parser_path)
+        return node.parser
 
 
 """ CMD Registration API
@@ -604,7 +1002,7 @@ def module(mod_name, *args,
     """
 
     mod_entry = CmdStorage.get_entry(mod_name)
-    mod_entry.references.update(refs)
+    mod_entry.add_references(refs)
     mod_entry.register_parser(*args, **kw)
     if as_main:
         return mod_entry.by_main_func(permission).wrapper
@@ -616,7 +1014,7 @@ def group(mod_name,
           # group parameters
           group_name = None, description=None):
     mod_entry = CmdStorage.get_entry(mod_name)
-    mod_entry.references.update(refs)
+    mod_entry.add_references(refs)
     def _func(func):
         gname = CmdName.from_arg_name(func.__name__)
         if group_name is not None:
@@ -639,12 +1037,54 @@ def group(mod_name,
         return gfunc.wrapper(func)
     return _func
 
+def lazy_func(mod_path, func_name = None):
+    """ Lazy Implementation Interface
+
+        The decorated function only declares the module interface,
+            and the implementation named `func_name`(the decorated
+            function name by default) in `mod_path` is imported when
+            the module main function is invoked. This is helpful to
+            register modules depending on heavy third library.
+
+        >>> @option("--key-file")
+        >>> @module("ssh.key", as_main=True)
+        >>> @lazy_func("bbcode.ssh.key")
+        >>> def load_rsa(args):
+        >>>     pass
+    """
+    def _func(func):
+        impl_name = func_name or func.__name__
+
+        @functools.wraps(func)
+        def _lazy_func(*args, **kw):
+            impl_mod = importlib.import_module(mod_path)
+            return getattr(impl_mod, impl_name)(*args, **kw)
+        return _lazy_func
+    return _func
+
 def prepare(refs=[]):
     return module(CmdStorage.GLOBAL_NAME, refs=refs, as_main=True)
 
-def Run():
-    root_parser = CmdStorage.init_parsers()
-    args = root_parser.parse_args()
+def Run(argv = None, packages = [], manifest = None, sources = [],
+        env = []):
+    """ Parse the command line and run the module main function
+
+        Only the parsers on the invoked module path will be created,
+            see `CmdStorage.init_parsers` for more details.
+
+        @param packages: module packages to be imported.
+        @param manifest: cache file path of resolved modules, the
+            packages import is skipped if it's up to date.
+        @param sources: source files or directories as manifest key.
+        @param env: environment names read by option defaults, which
+            are part of the manifest key.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    CmdStorage.load(packages, manifest, sources, env)
+    root_parser = CmdStorage.init_parsers(argv)
+    args = root_parser.parse_args(argv)
 
     if getattr(args, "func", None):
         args.func(args)
@@ -654,3 +1094,46 @@ def Run():
         "cannot find the mainly function to run, " +
         "please set main function via mod_main or group_main."
     )
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    def benchmark(mod_num=5000, cluster=50, commons=20, refs=8):
+        """ Resolve synthetic modules with dense references
+
+            Modules are divided into clusters, each module refers to
+                `refs` random modules in its cluster, which form
+                reference cycles, and one of the common modules.
+        """
+        rand = random.Random(0)
+        names = ["bench.common.c%d" % i for i in range(commons)]
+        for name in names:
+            option("--" + name.replace(".", "-"))(
+                module(name, help=name)(lambda args: None))
+
+        for i in range(mod_num):
+            start = (i // cluster) * cluster
+            mod_refs = ["bench.m%d" % rand.randrange(
+                start, min(start + cluster, mod_num)) \
+                for _ in range(refs)]
+            mod_refs.append(rand.choice(names))
+            option("--opt-m%d" % i, help="option %d" % i)(
+                module("bench.m%d" % i, as_main=True,
+                       refs=mod_refs, help="module %d" % i)(
+                    lambda args: None))
+
+        tic = time.perf_counter()
+        CmdStorage.resolve()
+        toc = time.perf_counter()
+        CmdStorage.init_parsers(["bench", "m0"])
+        end = time.perf_counter()
+
+        group_num = sum([len(e.groups) \
+            for e in CmdStorage.MODULES.values()])
+        print("modules: {}, references: {}, merged groups: {}".format(
+            mod_num, mod_num * (refs + 1), group_num))
+        print("resolve: {:.3f}s, lazy parsers: {:.3f}s".format(
+            toc - tic, end - toc))
+
+    benchmark()
@@ -0,0 +1,121 @@
+""" Service Control Endpoint
+
+    The control endpoint listens on an unix domain socket along with
+    the services started via `thread.Run`, and serves the requests
+    to inspect or manage the running services, like `script.py ssh
+    ctl services`.
+
+    Each request and response is one line of JSON:
+        request: {"command": "services", "target": ...}
+        response: {"ok": true, "result": ...} or
+            {"ok": false, "error": "..."}
+
+    Modules can register their own commands via `register_command`,
+    like the channels of reverse tunnel. In the process service mode,
+    only the services are visible, the module states live in the
+    child processes.
+"""
+import os
+import json
+import socket
+import logging
+from os import path
+
+from . import base, thread
+
+logger = logging.getLogger("control")
+
+CONTROL_ROOT = path.join(base.CACHE_ROOT, "control")
+
+__COMMANDS__ = {}
+
+def socket_path(name):
+    """ Default control socket of the invoked module """
+    return path.join(CONTROL_ROOT, "{}.sock".format(name or "bbcode"))
+
+def register_command(name):
+    """ func: request dict as argument, returns JSON serializable """
+    def _func(func):
+        __COMMANDS__[name] = func
+        return func
+    return _func
+
+@register_command("help")
+def list_commands(request):
+    return sorted(__COMMANDS__.keys())
+
+@register_command("services")
+def list_services(request):
+    return [dict(name=name, **stats.as_dict()) \
+        for name, stats in thread.service_stats().items()]
+
+@register_command("reconnect")
+def reconnect_service(request):
+    thread.reconnect(request["target"])
+    return "service {} is reconnecting".format(request["target"])
+
+def handle(request : dict) -> dict:
+    func = __COMMANDS__.get(request.get("command", None), None)
+    if func is None:
+        return {"ok": False, "error": "unknown command: {}, {}".format(
+            request.get("command", None), list_commands(request))}
+
+    try:
+        return {"ok": True, "result": func(request)}
+    except Exception as e:
+        return {"ok": False, "error": "{}: {}".format(
+            type(e).__name__, e)}
+
+async def serve(socket_file, quit):
+    import asyncio
+    if path.exists(socket_file):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            if probe.connect_ex(socket_file) == 0:
+                logger.warning("control socket {} is in use, skip".format(
+                    socket_file))
+                return
+        os.remove(socket_file)
+
+    async def _client(reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            # commands may block, like the stop handlers
+            response = await thread.run_in_thread(handle, request)
+            writer.write((json.dumps(response, default=str) + "\n").encode())
+            await writer.drain()
+        except Exception as e:
+            logger.debug("control request failed: {}".format(e))
+        finally:
+            writer.close()
+
+    base.make_dirs(path.dirname(path.abspath(socket_file)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_file)
+    # owner only like the command server, the connections are
+    #   refused until listen in start_unix_server.
+    os.chmod(socket_file, 0o600)
+    server = await asyncio.start_unix_server(_client, sock=sock)
+    logger.info("control socket listening on {}".format(socket_file))
+    try:
+        await quit.wait()
+    finally:
+        server.close()
+        if path.exists(socket_file):
+            os.remove(socket_file)
+
+def request(socket_file, command, **kw):
+    """ Send command to control socket, return the result """
+    if not path.exists(socket_file):
+        raise RuntimeError("control socket {} not exists".format(
+            socket_file))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_file)
+        sock.sendall((json.dumps(dict(kw, command=command)) + "\n").encode())
+        with sock.makefile("r") as reader:
+            response = json.loads(reader.readline())
+
+    if not response["ok"]:
+        raise RuntimeError(response["error"])
+    return response["result"]
@@ -1,3 +1,4 @@
+import shlex
 import logging
 from os import path
 
@@ -23,16 +24,12 @@ cmd.module("git",
 def clone(args):
     base.make_dirs(args.git_root)
     with base.enter(args.git_root):
-        if not path.exists(args.name):
-            command = ["git", "clone", "--recurse-submodules",
-                       args.url, args.name]
-            base.shell_exec(
-                "git clone --recurse-submodules", args.url, args.name,
-                check_error=True)
+        if not path.exists(base.abspath(args.name)):
+            base.run(["git", "clone", "--recurse-submodules",
+                      args.url, args.name])
 
         if args.branch:
-            with base.enter(args.name):
-                base.shell_exec("git checkout", args.branch, check_error=True)
+            base.run(["git", "checkout", args.branch], cwd=args.name)
 
 @cmd.option("-d", "--delete",
             action="append", default=[],
@@ -40,6 +37,9 @@ def clone(args):
 @cmd.option("-l", "--list-number",
             type=int, default=5,
             help="file numbers to be display, by default 5")
+@cmd.option("-j", "--jobs",
+            type=int, default=1,
+            help="number of git pipelines to run concurrently")
 @cmd.option("--git-path", default=".",
             help="git project root path to clean")
 @cmd.module("git.clean", as_main=True,
@@ -54,45 +54,35 @@ and then user will select unuseful files to delete with option:
 def clean(args):
     for del_file in args.delete:
         logger.info("git delete " + del_file)
-        base.shell_exec(
-            "git filter-branch --force --index-filter ",
-            "\"git rm -rf --cached --ignore-unmatch {}\" ".format(del_file),
-            "--prune-empty --tag-name-filter cat -- --all"
-        )
+        base.run([
+            "git", "filter-branch", "--force", "--index-filter",
+            "git rm -rf --cached --ignore-unmatch " + shlex.quote(del_file),
+            "--prune-empty", "--tag-name-filter", "cat", "--", "--all"])
 
     if args.delete:
         logger.info("update all local branches")
-        base.shell_exec(
-            "git for-each-ref --format='delete %(refname)' refs/original | ",
-            "git update-ref --stdin")
-        base.shell_exec("git reflog expire --expire=now --all")
+        base.run(
+            "git for-each-ref --format='delete %(refname)' refs/original | " +
+            "git update-ref --stdin", shell=True)
+        base.run(["git", "reflog", "expire", "--expire=now", "--all"])
 
         logger.info("start git gc")
-        base.shell_exec("git gc --prune=now")
-        base.shell_exec("git count-objects -v")
+        base.run(["git", "gc", "--prune=now"])
+        base.run(["git", "count-objects", "-v"])
 
         logger.info("push into remote repository")
-        base.shell_exec("git push origin --force --all")
-        base.shell_exec("git push origin --force --tags")
+        base.run(["git", "push", "origin", "--force", "--all"])
+        base.run(["git", "push", "origin", "--force", "--tags"])
 
-    with base.enter(args.git_path):
-        logger.info("list large file names")
-        base.shell_exec(
-            "git verify-pack -v .git/objects/pack/*.idx | ",
-            "sort -k 3 -nr | ",
-            "head -" + str(args.list_number),
-            check_error=True)
-
-        base.shell_exec(
-            "git rev-list --objects --all | ",
-            "grep",
-            "\"$(",
-                "git verify-pack -v .git/objects/pack/*.idx | ",
-                "sort -k 3 -nr | ",
-                "head -" + str(args.list_number) + " | ",
-                "awk '{print$1}'",
-            ")\"",
-            check_error=True)
+    logger.info("list large file names")
+    large_files = "git verify-pack -v .git/objects/pack/*.idx | " + \
+        "sort -k 3 -nr | head -" + str(args.list_number)
+    with base.JobPool(jobs=args.jobs) as pool:
+        pool.submit(large_files, shell=True, cwd=args.git_path)
+        pool.submit(
+            "git rev-list --objects --all | grep \"$(" + \
+                large_files + " | awk '{print$1}')\"",
+            shell=True, cwd=args.git_path)
 
 if __name__ == "__main__":
     from . import log
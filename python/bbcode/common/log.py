@@ -1,7 +1,16 @@
 from datetime import datetime
 from typing import List
 
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
 import logging
+import threading
+import functools
 
 TRACE = logging.DEBUG // 2
 DEBUG = logging.DEBUG
@@ -50,42 +59,212 @@ class ColorFormatter(logging.Formatter):
         message = log_color + message + self._reset
         return message
 
+class TokenBucket:
+    """ Allow burst events at once, and refill rate events per second """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.suppressed = 0
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def take_suppressed(self) -> int:
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+class RateLimitFilter(logging.Filter):
+    """ Token bucket per logger and message template
+
+        The similar messages, aka the same unformatted message with
+            different arguments, share one bucket, so the log calls
+            should pass the arguments lazily:
+            `logger.info("closing %s", info)`.
+
+        The count of suppressed messages is appended to the next
+            passed message of the same bucket, or logged as a summary
+            record every summary_interval seconds if no message passes.
+
+        max_level: the records above are never limited, like errors,
+            or all the records are limited if None.
+    """
+    def __init__(self, rate=1., burst=10, max_keys=4096,
+                 summary_interval=10., max_level=None):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.max_level = max_level
+        self.summary_interval = summary_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def filter(self, record):
+        if getattr(record, "rate_summary", False):
+            return True
+        if self.max_level is not None and record.levelno > self.max_level:
+            return True
+
+        key = (record.name, record.levelno, str(record.msg))
+        with self._lock:
+            bucket = self._buckets.get(key, None)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[key] = bucket
+
+            if not bucket.consume():
+                self._start_flusher()
+                return False
+            suppressed = bucket.take_suppressed()
+
+        if suppressed:
+            record.msg = "%s (suppressed %d similar messages)" % (
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="log.rate_limit", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.summary_interval)
+            self.flush()
+
+    def flush(self):
+        """ Log the suppressed counts not reported yet """
+        with self._lock:
+            summaries = [(key, bucket.take_suppressed()) \
+                for key, bucket in self._buckets.items() if bucket.suppressed]
+
+        for (name, levelno, msg), suppressed in summaries:
+            logger = logging.getLogger(name)
+            record = logger.makeRecord(
+                name, levelno, "(rate_limit)", 0,
+                "suppressed %d similar messages: %s",
+                (suppressed, msg), None)
+            record.rate_summary = True
+            logger.handle(record)
+
+def rate_limited(rate=1., burst=10):
+    """ Skip the calls exceeding rate, like the logging helpers
+            invoked per connection, the suppressed count is logged
+            before the next passed call.
+    """
+    def _func(func):
+        bucket = TokenBucket(rate, burst)
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def _limited(*args, **kw):
+            with lock:
+                if not bucket.consume():
+                    return None
+                suppressed = bucket.take_suppressed()
+
+            if suppressed:
+                logging.getLogger("log").info(
+                    "suppressed %d calls of %s", suppressed, func.__qualname__)
+            return func(*args, **kw)
+        return _limited
+    return _func
+
 class FilterList(logging.Filter):
     """ Filter with logging module
 
         Filter rules as below:
             {allow|disable log name} > level no > keywords >
             {inheritance from parent log name} > by default filter
+
+        The rules of each log name are resolved once into the
+            decision cache, which is cleared if rules are changed.
+        The allowed records are limited by rate_limit if set.
         TODO:
     """
     def __init__(self, default=False, allows=[], disables=[],
-            keywords=[], log_level=logging.INFO):
+            keywords=[], log_level=logging.INFO, rate_limit=None):
         self.rules = {}
+        # RateLimitFilter applied to the allowed records
+        self.rate_limit = rate_limit
         self._internal_filter_rule = "_internal_filter_rule"
+        # log name -> (exactly matched, inherited rule)
+        self._decisions = {}
         self.log_level = log_level
         self.keywords = keywords
 
         self.rules[self._internal_filter_rule] = default
         for name in allows:
-            splits = name.split(".")
-            rules = self.rules
-            for split in splits:
-                if split not in rules:
-                    rules[split] = {}
-                rules = rules[split]
+            self.add_rule(name, True)
+        for name in disables:
+            self.add_rule(name, False)
 
-            rules[self._internal_filter_rule] = True
+    def add_rule(self, name, allow):
+        splits = name.split(".")
+        rules = self.rules
+        for split in splits:
+            if split not in rules:
+                rules[split] = {}
+            rules = rules[split]
 
-        for name in disables:
-            splits = name.split(".")
-            rules = self.rules
-            for split in splits:
-                if split not in rules:
-                    rules[split] = {}
-                rules = rules[split]
+        rules[self._internal_filter_rule] = allow
+        self._decisions.clear()
 
-            rules[self._internal_filter_rule] = False
+    def decision(self, name):
+        rules = self.rules
+        rv = rules[self._internal_filter_rule]
+
+        for split in name.split("."):
+            if split not in rules:
+                return False, rv
+
+            rules = rules[split]
+            if self._internal_filter_rule in rules:
+                rv = rules[self._internal_filter_rule]
+        return True, rv
 
+    def filter(self, record):
+        if not self.allow(record):
+            return False
+        return self.rate_limit is None or self.rate_limit.filter(record)
+
+    def allow(self, record):
+        decision = self._decisions.get(record.name, None)
+        if decision is None:
+            decision = self.decision(record.name)
+            self._decisions[record.name] = decision
+
+        exact, rv = decision
+        if exact:
+            return rv
+        if rv or record.levelno >= self.log_level:
+            return True
+
+        # format message only if keywords may change the result
+        if self.keywords:
+            message = record.getMessage()
+            for keyword in self.keywords:
+                if keyword in message:
+                    return True
+        return False
+
+class LegacyFilterList(FilterList):
+    """ The rules walk per record before, kept for benchmark only """
     def filter(self, record):
         rules = self.rules
         rv = rules[self._internal_filter_rule]
@@ -106,8 +285,244 @@ class FilterList(logging.Filter):
                 return rv
         return rv
 
-def Init(log_level):
+class DropQueueHandler(logging.Handler):
+    """ Enqueue records without blocking the producer thread, the
+            records are dropped and counted if the queue is full.
+    """
+    def __init__(self, records : queue.Queue):
+        super(DropQueueHandler, self).__init__()
+        self.records = records
+        self.dropped = 0
+
+    def emit(self, record):
+        # merge arguments since they may be changed after enqueued
+        record.msg = record.getMessage()
+        record.args = None
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchListener:
+    """ Single thread formats and writes the queued records in batch """
+    def __init__(self, records : queue.Queue, handlers, batch_size=256):
+        self.records = records
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.producer = None
+        self._reported = 0
+        self._thread = threading.Thread(
+            target=self.listen, name="log-listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        try:
+            self.records.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def report_dropped(self, batch):
+        dropped = self.producer.dropped if self.producer else 0
+        if dropped == self._reported:
+            return
+        batch.append(logging.makeLogRecord({
+            "name": "log", "levelno": WARN, "levelname": "WARN",
+            "msg": "dropped {} log records since queue is full".format(
+                dropped - self._reported)}))
+        self._reported = dropped
+
+    def write(self, batch):
+        for handler in self.handlers:
+            stream = getattr(handler, "stream", None)
+            if stream is None:
+                for r in batch:
+                    if r.levelno >= handler.level:
+                        handler.handle(r)
+                continue
+
+            lines = [handler.format(r) + "\n" for r in batch \
+                if r.levelno >= handler.level and handler.filter(r)]
+            if not lines:
+                continue
+
+            with handler.lock:
+                stream.write("".join(lines))
+                handler.flush()
+
+    def listen(self):
+        stopped = False
+        while not stopped:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stopped = True
+                batch = [r for r in batch if r is not None]
+            self.report_dropped(batch)
+            try:
+                self.write(batch)
+            except Exception:
+                # the listener must not die for broken handler
+                pass
+
+class JsonFormatter(logging.Formatter):
+    """ One compact JSON object per record, without the strftime cost """
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "name": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+class RotatingSink(logging.Handler):
+    """ JSON lines file sink with batched writes
+
+        The formatted lines are buffered and written in batch when
+            batch_size lines are buffered or flush_interval seconds
+            elapsed, and fsync-ed every fsync_interval seconds.
+
+        The file is rotated when exceeding max_bytes or opened longer
+            than rotate_interval seconds, the rotated segment is
+            compressed as `<file>.<timestamp>.gz` in background, and
+            only the newest backups segments are kept.
+    """
+    def __init__(self, file_path, max_bytes=64 << 20,
+                 rotate_interval=24 * 3600, backups=10,
+                 batch_size=512, flush_interval=1., fsync_interval=10.):
+        super(RotatingSink, self).__init__()
+        self.file_path = os.path.abspath(os.path.expanduser(file_path))
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.setFormatter(JsonFormatter())
+
+        self._buffer = []
+        self._file = None
+        self._closed = False
+        self._last_fsync = time.monotonic()
+        self.open()
+
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="log-sink", daemon=True)
+        self._flusher.start()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        self._file = open(self.file_path, "ab")
+        self._size = self._file.tell()
+        self._opened = time.time()
+
+    def emit(self, record):
+        try:
+            self._buffer.append((self.format(record) + "\n").encode())
+            if len(self._buffer) >= self.batch_size:
+                self._write()
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        """ Write buffered lines, the caller should hold the lock """
+        if self._buffer and self._file is not None:
+            data = b"".join(self._buffer)
+            self._buffer = []
+            self._file.write(data)
+            self._size += len(data)
+            self._file.flush()
+
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+        if self._size >= self.max_bytes or \
+                time.time() - self._opened >= self.rotate_interval:
+            self.rotate()
+
+    def rotate(self):
+        if self._size == 0:
+            self._opened = time.time()
+            return
+
+        self._file.close()
+        now = time.time()
+        segment = "{}.{}-{:06d}".format(self.file_path,
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+            int(now % 1 * 1e6))
+        os.replace(self.file_path, segment)
+        self.open()
+        threading.Thread(target=self.compress, args=(segment,),
+                         name="log-compress", daemon=True).start()
+
+    def compress(self, segment):
+        prefix = os.path.basename(self.file_path) + "."
+        dirname = os.path.dirname(self.file_path)
+        try:
+            with open(segment, "rb") as fin, \
+                    gzip.open(segment + ".gz", "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(segment)
+
+            segments = sorted([f for f in os.listdir(dirname) \
+                if f.startswith(prefix) and f.endswith(".gz")])
+            for f in segments[:max(len(segments) - self.backups, 0)]:
+                os.remove(os.path.join(dirname, f))
+        except OSError:
+            # the segment may be pruned by the concurrent thread
+            return
+
+    def _flush_loop(self):
+        while not self._closed:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # retry in next interval, like disk is full
+                pass
+
+    def flush(self):
+        with self.lock:
+            if self._file is not None:
+                self._write()
+
+    def close(self):
+        with self.lock:
+            self._closed = True
+            if self._file is not None:
+                self._write()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+        super(RotatingSink, self).close()
+
+LOG_BACKENDS = ["sync", "queue"]
+
+def Init(log_level, backend="sync", queue_size=8192,
+         log_file=None, **sink_options):
+    """ backend: sync writes records in the caller thread, and queue
+            writes records via listener thread, which never blocks
+            the caller but drops records if queue_size is exceeded.
+        log_file: write JSON lines into rotating file besides the
+            terminal, sink_options are passed to `RotatingSink`.
+    """
     assert log_level in LOG_LEVELS
+    assert backend in LOG_BACKENDS
     logging.basicConfig(level=log_level)
     formatter = ColorFormatter(
             fmt="[ %(asctime)s %(name)10s %(levelname)5s ] %(message)s",
@@ -120,6 +535,22 @@ def Init(log_level):
         handler.addFilter(log_filter)
         handler.setFormatter(formatter)
 
+    if log_file:
+        sink = RotatingSink(log_file, **sink_options)
+        sink.addFilter(log_filter)
+        logging.root.addHandler(sink)
+
+    if backend == "queue":
+        records = queue.Queue(queue_size)
+        listener = BatchListener(records, list(logging.root.handlers))
+        producer = DropQueueHandler(records)
+        # filter in producer to skip enqueuing the dropped records
+        producer.addFilter(log_filter)
+        listener.producer = producer
+        logging.root.handlers = [producer]
+        listener.start()
+        atexit.register(listener.stop)
+
 if __name__ == "__main__":
     from . import cmd
 
@@ -132,4 +563,37 @@ if __name__ == "__main__":
         logging.warning("test")
         logging.error("test")
 
+    @cmd.option("--records", type=int, default=500000,
+                help="number of records per logger")
+    @cmd.module("log.bench", as_main=True,
+        help="log filter microbenchmark", permission=cmd.PRIVATE)
+    def bench_filter(args):
+        """ FilterList.filter calls per second against the legacy
+                rules walk, with the tunnel loggers enabled.
+        """
+        rules = dict(
+            allows=["ssh.tunnel.reverse", "ssh.proxy", "service"],
+            disables=["paramiko"],
+            keywords=["failed"],
+            log_level=INFO)
+        names = ["ssh.tunnel.reverse", "ssh.proxy", "service",
+                 "paramiko.transport", "bash"]
+
+        def _bench(log_filter, record):
+            func = log_filter.filter
+            start = time.perf_counter()
+            for _ in range(args.records):
+                func(record)
+            return args.records / (time.perf_counter() - start)
+
+        print("%-20s %14s %14s" % ("logger", "legacy/sec", "cached/sec"))
+        for name in names:
+            record = logging.LogRecord(
+                name, TRACE, __file__, 0,
+                "channel %d forward %d bytes", (1, 1024), None)
+            legacy, cached = LegacyFilterList(**rules), FilterList(**rules)
+            assert legacy.filter(record) == cached.filter(record), name
+            print("%-20s %14.0f %14.0f" % (
+                name, _bench(legacy, record), _bench(cached, record)))
+
     cmd.Run()
@@ -0,0 +1,165 @@
+""" Profiler for Module Function and Services
+
+    The profiler is started in the global prepare function, before
+    the module main function is invoked, and the result is dumped at
+    process exit, after all the services started via `thread.Run`
+    are stopped. The output file is named after the invoked module,
+    aka `ssh.tunnel.cpu.pstats`.
+
+    Profile Modes
+    =============
+    cpu: cProfile for main thread and the threads started via
+        `thread.as_thread_func`, dumped as pstats file. Since python
+        3.12 the profile is process wide, which covers all threads.
+    mem: tracemalloc snapshot of alive allocations, dumped as
+        collapsed stacks weighted by bytes.
+    wall: sampling stacks of all threads periodically, dumped as
+        collapsed stacks weighted by sample count.
+
+    Collapsed stacks file can be rendered via flamegraph tools.
+"""
+import os
+import sys
+import atexit
+import logging
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+from os import path
+from collections import Counter
+
+from . import thread
+
+logger = logging.getLogger("profiler")
+
+PROFILE_MODES = ["cpu", "mem", "wall"]
+
+# cProfile hooks sys.monitoring since 3.12, which is process wide and
+#   one profile at a time, so the per thread profiles are not needed.
+CPU_PROCESS_WIDE = sys.version_info >= (3, 12)
+
+def frame_name(filename, lineno, func_name=None):
+    name = "{}:{}".format(path.basename(filename), lineno)
+    if func_name:
+        name = "{} ({})".format(func_name, name)
+    return name
+
+def dump_collapsed(counter : Counter, file_path):
+    with open(file_path, "w") as f:
+        for stack, count in counter.most_common():
+            f.write("{} {}\n".format(stack, count))
+
+class CpuProfiler:
+    ext = "pstats"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._main = cProfile.Profile()
+        self._stats = None
+
+    def start(self):
+        if not CPU_PROCESS_WIDE:
+            thread.register_thread_hook(self.thread_profile)
+        self._main.enable()
+
+    @contextlib.contextmanager
+    def thread_profile(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add_profile(profile)
+
+    def add_profile(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def stop(self, file_path):
+        self._main.disable()
+        self.add_profile(self._main)
+        self._stats.dump_stats(file_path)
+
+class MemProfiler:
+    ext = "folded"
+
+    def __init__(self, frames=32):
+        self._frames = frames
+
+    def start(self):
+        tracemalloc.start(self._frames)
+
+    def stop(self, file_path):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        counter = Counter()
+        for stat in snapshot.statistics("traceback"):
+            stack = ";".join([frame_name(f.filename, f.lineno) \
+                for f in stat.traceback])
+            counter[stack] += stat.size
+        dump_collapsed(counter, file_path)
+
+class WallProfiler:
+    ext = "folded"
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._counter = Counter()
+        self._quit = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.sample, name="wall-profiler", daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        ident = threading.get_ident()
+        while not self._quit.wait(self._interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(frame_name(
+                        code.co_filename, frame.f_lineno, code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                self._counter[";".join(reversed(stack))] += 1
+
+    def stop(self, file_path):
+        self._quit.set()
+        self._thread.join()
+        dump_collapsed(self._counter, file_path)
+
+PROFILERS = {
+    "cpu": CpuProfiler,
+    "mem": MemProfiler,
+    "wall": WallProfiler,
+}
+
+def start(mode, name, out_dir="."):
+    """ Start profiler and dump result at process exit """
+    profiler = PROFILERS[mode]()
+    file_path = path.join(out_dir, "{}.{}.{}".format(
+        name or "bbcode", mode, profiler.ext))
+
+    def _stop():
+        profiler.stop(file_path)
+        logger.info("{} profile is written into {}".format(
+            mode, file_path))
+
+    os.makedirs(out_dir, exist_ok=True)
+    profiler.start()
+    atexit.register(_stop)
+    return profiler
@@ -0,0 +1,173 @@
+""" BBCode Command Server
+
+    The server preloads all the bbcode packages and the resolved
+    command registry, and listens on an unix domain socket. Each
+    request from `client.forward` is executed in a forked worker, so
+    the module states like `cmd.CmdStorage` and registered services
+    are isolated between commands, and the worker costs nothing but
+    the fork and parse.
+
+    The server replies stale and exits once the python sources have
+    been modified, and the client will fall back to run locally.
+"""
+import os
+import sys
+import json
+import atexit
+import signal
+import socket
+import logging
+import traceback
+import importlib
+from os import path
+
+from . import base, cmd, client, thread
+
+logger = logging.getLogger("server")
+
+# python source directory, which contains the bbcode package
+BBCODE_SOURCE = path.abspath(path.join(__file__, "../../.."))
+
+def source_key():
+    return cmd.CmdStorage.manifest_key([
+        path.realpath(sys.argv[0]), BBCODE_SOURCE])
+
+def preload():
+    """ Import all the python modules under bbcode directory """
+    for root, dirs, names in os.walk(path.join(BBCODE_SOURCE, "bbcode")):
+        dirs[:] = sorted([d for d in dirs if d != "__pycache__"])
+        for name in sorted(names):
+            if not name.endswith(".py") or name == "__main__.py":
+                continue
+            mod_path = path.relpath(
+                path.join(root, name[:-3]), BBCODE_SOURCE)
+            mod_name = mod_path.replace(os.sep, ".")
+            if mod_name.endswith(".__init__"):
+                mod_name = mod_name[:-len(".__init__")]
+
+            try:
+                importlib.import_module(mod_name)
+            except Exception as e:
+                logger.warning("skip preload module {}: {}".format(
+                    mod_name, e))
+
+def recv_request(conn):
+    data, fds, _, _ = socket.recv_fds(conn, 1 << 16, 3)
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode()), fds
+
+def run_worker(conn):
+    """ Forked worker process, never returns """
+    for sig in ('TERM', 'HUP', 'CHLD'):
+        signal.signal(getattr(signal, 'SIG'+sig), signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    exit_code = 0
+    try:
+        request, fds = recv_request(conn)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = sys.argv[:1] + request["argv"]
+        client.send_message(conn, pid=os.getpid())
+
+        # logging is initialized by the prepare function
+        logging.root.handlers.clear()
+        cmd.Run(request["argv"])
+        thread.Run()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except KeyboardInterrupt:
+        exit_code = 130
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+
+    try:
+        # worker exits via os._exit, run exit functions like profilers
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        client.send_message(conn, exit=exit_code)
+    finally:
+        os._exit(exit_code)
+
+def reap_workers():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+@cmd.option("--socket", metavar="FILE",
+            default=client.SOCKET_FILE,
+            help="unix socket file to listen, by default: " + \
+                client.SOCKET_FILE)
+@cmd.module("server", as_main=True,
+            help="prewarmed command server",
+            description="""
+BBCode Command Server
+
+  Preload all the packages and listen on the unix socket, then the
+    main script will forward commands into the server and run in a
+    forked worker, which saves the interpreter start, imports and
+    parsers construction.
+
+  The server exits if the sources are modified, and the commands
+    will run locally until the server restarts.
+""")
+def serve(args):
+    if path.exists(args.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            if probe.connect_ex(args.socket) == 0:
+                raise RuntimeError(
+                    "server is already running at {}".format(args.socket))
+        os.remove(args.socket)
+
+    preload()
+    key = source_key()
+
+    base.make_dirs(path.dirname(path.abspath(args.socket)))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(args.socket)
+    # owner only since it runs any command, the connections are
+    #   refused until listen, so there is no window after bind.
+    os.chmod(args.socket, 0o600)
+    listener.listen(128)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info("listening on {}".format(args.socket))
+
+    try:
+        while True:
+            conn, _ = listener.accept()
+            reap_workers()
+
+            if source_key() != key:
+                logger.info("sources are modified, shutting down ...")
+                client.send_message(conn, stale=True)
+                conn.close()
+                break
+
+            if os.fork() == 0:
+                listener.close()
+                run_worker(conn)
+            conn.close()
+    finally:
+        listener.close()
+        if path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,179 @@
+""" Step Graph for Multi-Step Installers
+
+    Steps declare the dependent steps, input and output paths, and the
+    independent steps run concurrently. Each finished step writes a
+    stamp file under `base.CACHE_ROOT`, and the step is skipped in the
+    next run if:
+
+        1. all the output paths exist,
+        2. the fingerprint of inputs and params is not changed,
+        3. the stamp is not expired, if ttl is set,
+        4. none of the dependent steps is executed.
+
+    >>> graph = task.Graph("n2n.install")
+    >>> graph.add("download", download, outputs=[n2n_root])
+    >>> graph.add("compile", compile, deps=["download"],
+    >>>           inputs=[n2n_root], outputs=[binary])
+    >>> graph.run(args)
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import contextvars
+from os import path
+from concurrent import futures
+
+from . import base, trace
+
+logger = logging.getLogger("task")
+
+STAMP_ROOT = path.join(base.CACHE_ROOT, "stamps")
+
+SKIPPED = "skipped"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+def path_fingerprint(file_path):
+    """ Shallow fingerprint of path, the directory is not walked """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+class Step:
+    def __init__(self, name, func, deps=[], inputs=[], outputs=[],
+                 params=None, ttl=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # the arguments affecting the result, like install path
+        self.params = params
+        self.ttl = ttl
+
+        self.status = None
+        self.duration = 0.
+
+    def fingerprint(self) -> str:
+        data = {
+            "inputs": {base.abspath(p): path_fingerprint(base.abspath(p)) \
+                for p in self.inputs},
+            "outputs": [base.abspath(p) for p in self.outputs],
+            "params": self.params,
+        }
+        return hashlib.sha1(json.dumps(
+            data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def up_to_date(self, stamp_file) -> bool:
+        if not path.exists(stamp_file):
+            return False
+        for p in self.outputs:
+            if not path.exists(base.abspath(p)):
+                return False
+        if self.ttl is not None and \
+                os.stat(stamp_file).st_mtime + self.ttl < time.time():
+            return False
+
+        with open(stamp_file, "r") as f:
+            return f.read() == self.fingerprint()
+
+class Graph:
+    def __init__(self, name, stamp_dir=None):
+        self.name = name
+        self.stamp_dir = stamp_dir or path.join(STAMP_ROOT, name)
+        self.steps = {}
+
+    def add(self, name, func, **kw) -> Step:
+        """ Add step, the func is invoked with the run arguments """
+        base.validate(name not in self.steps,
+                      "step {} is already added".format(name))
+        for dep in kw.get("deps", []):
+            base.validate(dep in self.steps,
+                          "step {} depends on unknown {}".format(name, dep))
+        step = Step(name, func, **kw)
+        self.steps[name] = step
+        return step
+
+    def stamp_file(self, step : Step):
+        return path.join(self.stamp_dir, step.name)
+
+    def run_step(self, step : Step, args, force):
+        stamp_file = self.stamp_file(step)
+        rerun = force or any(
+            [self.steps[d].status == DONE for d in step.deps])
+        if not rerun and step.up_to_date(stamp_file):
+            step.status = SKIPPED
+            logger.info("step {} is up to date".format(step.name))
+            return
+
+        logger.info("step {} started".format(step.name))
+        if path.exists(stamp_file):
+            os.remove(stamp_file)
+
+        start = time.perf_counter()
+        try:
+            with trace.span(self.name + "." + step.name, cat="step"):
+                step.func(args)
+        finally:
+            step.duration = time.perf_counter() - start
+
+        base.make_dirs(self.stamp_dir)
+        with open(stamp_file, "w") as f:
+            f.write(step.fingerprint())
+        step.status = DONE
+
+    def run(self, args, jobs=None, force=False):
+        """ Run steps in the dependency order
+
+            jobs: number of concurrent steps, all the ready steps are
+                started by default since they mostly wait for commands.
+            force: ignore the stamps and run all steps.
+        """
+        for step in self.steps.values():
+            step.status, step.duration = None, 0.
+
+        pending = dict(self.steps)
+        running = {}
+        error = None
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(
+                max_workers=jobs or len(self.steps) or 1,
+                thread_name_prefix="step") as executor:
+            while pending or running:
+                if error is None:
+                    ready = [s for s in pending.values() if all(
+                        [self.steps[d].status in [DONE, SKIPPED] \
+                            for d in s.deps])]
+                    for step in ready:
+                        del pending[step.name]
+                        running[executor.submit(
+                            contextvars.copy_context().run,
+                            self.run_step, step, args, force)] = step
+
+                if not running:
+                    break
+                finished, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    if future.exception() is not None:
+                        step.status = FAILED
+                        error = error or future.exception()
+
+        for step in pending.values():
+            step.status = CANCELLED
+        self.report(time.perf_counter() - start)
+        if error is not None:
+            raise error
+
+    def report(self, duration):
+        logger.info("{} steps finished in {:.3f}s".format(
+            self.name, duration))
+        for step in self.steps.values():
+            logger.info("  %-20s %-10s %.3fs" % (
+                step.name, step.status, step.duration))
@@ -1,121 +1,718 @@
 import os
 import sys
+import time
+import queue
+import random
 import logging
+import threading
 import signal
+import contextlib
+import contextvars
 from threading import Event, Thread
 
+from . import trace
+
+# asyncio and multiprocessing are imported once services are served,
+#   which costs tens of milliseconds for every invocation otherwise.
+
 __QUIT_EVENTS__ = []
+__THREAD_HOOKS__ = []
+
+def register_thread_hook(hook):
+    """ Register context manager factory entered in every thread
+            started via `as_thread_func`, like profilers.
+    """
+    __THREAD_HOOKS__.append(hook)
+    return hook
+
+def run_with_hooks(func, *args, **kwargs):
+    with contextlib.ExitStack() as stack:
+        for hook in list(__THREAD_HOOKS__):
+            stack.enter_context(hook())
+        return func(*args, **kwargs)
+
+class ServiceExit(BaseException):
+    """ Raised in service via `wait_or_exit` while shutting down, it
+            derives from BaseException like SystemExit, so that the
+            `except Exception` in service does not swallow it.
+    """
+
+def _thread_main(func, *args, **kwargs):
+    try:
+        return run_with_hooks(func, *args, **kwargs)
+    except ServiceExit:
+        pass
 
 def as_thread_func(func):
     def _container(*args, **kwargs):
-        t = Thread(target=func, args=args, kwargs=kwargs)
+        # thread inherits the caller context, like working directory
+        t = Thread(target=contextvars.copy_context().run,
+                   args=(_thread_main, func, *args), kwargs=kwargs)
         t.start()
         return t
     return _container
 
+class PoolOverflow(RuntimeError):
+    """ Raised if the pool queue is full with reject policy """
+
+class ThreadPool:
+    """ Bounded worker threads for short-lived tasks
+
+        The `as_thread_func` spawns a thread per call, which is not
+            suitable for per-connection handlers under burst. The
+            pool reuses at most max_workers threads, and the tasks
+            are queued if all workers are busy.
+
+        overflow: policy if max_queue tasks are waiting,
+            REJECT: raise PoolOverflow in submit,
+            WAIT: block the submitter until the queue is available.
+    """
+    REJECT = "reject"
+    WAIT = "wait"
+    OVERFLOWS = [REJECT, WAIT]
+
+    def __init__(self, name, max_workers=32, max_queue=128,
+                 overflow=REJECT, idle_timeout=60):
+        if overflow not in ThreadPool.OVERFLOWS:
+            raise RuntimeError("unknown overflow policy: {}".format(
+                overflow))
+
+        self._name = name
+        self._max_workers = max_workers
+        self._overflow = overflow
+        self._idle_timeout = idle_timeout
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+
+        self.workers = 0
+        self.idle = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "active": self.active,
+                "queued": self._queue.qsize(),
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue the task, the caller context is inherited """
+        task = (contextvars.copy_context(), func, args, kwargs)
+        try:
+            self._queue.put(task, block=(self._overflow == ThreadPool.WAIT))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise PoolOverflow("pool {} is full: {}".format(
+                self._name, self.stats()))
+
+        with self._lock:
+            # idle workers may not have taken the queued tasks yet
+            if self._queue.qsize() <= self.idle or \
+                    self.workers >= self._max_workers:
+                return
+            self.workers += 1
+            self.idle += 1
+        Thread(target=self._worker, daemon=True,
+               name="{}-{}".format(self._name, self.workers)).start()
+
+    def _worker(self):
+        while True:
+            try:
+                ctx, func, args, kwargs = self._queue.get(
+                    timeout=self._idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # tasks may be queued just before timeout
+                    if self._queue.empty():
+                        self.workers -= 1
+                        self.idle -= 1
+                        return
+                continue
+
+            with self._lock:
+                self.idle -= 1
+                self.active += 1
+            try:
+                ctx.run(_thread_main, func, *args, **kwargs)
+            except Exception as e:
+                logger.error("pool {} task raise exception: {}".format(
+                    self._name, e))
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.idle += 1
+                    self.completed += 1
+
+async def run_in_thread(func, *args, **kwargs):
+    """ Run blocking function in daemon thread and await the result
+
+        The daemon thread never blocks the process exit, so that the
+            shutdown deadline is respected even if the function
+            ignores the quit events.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set(setter, value):
+        if not future.done():
+            setter(value)
+
+    def _target():
+        try:
+            result = (_set, future.set_result,
+                      run_with_hooks(func, *args, **kwargs))
+        except SystemExit:
+            # `sys.exit` only ends the service thread as before
+            result = (_set, future.set_exception, ServiceExit())
+        except BaseException as e:
+            result = (_set, future.set_exception, e)
+
+        try:
+            loop.call_soon_threadsafe(*result)
+        except RuntimeError:
+            # event loop is closed after shutdown deadline
+            pass
+
+    Thread(target=contextvars.copy_context().run, args=(_target,),
+           name=getattr(func, "__name__", "service"),
+           daemon=True).start()
+    return await future
+
+__SHUTDOWN__ = Event()
+
 def wait_or_exit(timeout):
+    """ Sleep in sync service, raise ServiceExit if shutting down """
     event = Event()
     __QUIT_EVENTS__.append(event)
-    event.wait(timeout)
+    if not __SHUTDOWN__.is_set():
+        event.wait(timeout)
     __QUIT_EVENTS__.remove(event)
 
-    if event.is_set():
-        os.sys.exit()
+    if __SHUTDOWN__.is_set():
+        raise ServiceExit()
 
 # service module
 
 __REGISTER_SERVICES__ = {}
 logger = logging.getLogger("service")
 
-class ThreadFunc:
+# seconds to wait for services after shutdown is requested
+SHUTDOWN_DEADLINE = 10
+
+class RestartPolicy:
+    """ Restart delay of auto reload service
+
+        The delay grows exponentially from interval to max_interval
+            for consecutive failures, and the full jitter is applied
+            to avoid restarting many hosts in lockstep. A service run
+            longer than stable seconds resets the failures.
+
+        crash_loop: consecutive failures to be treated as crash
+            loop, the restart log is escalated into error.
+        max_restarts: give up after consecutive failures, restart
+            forever if None.
+    """
+    def __init__(self, interval=5, max_interval=300, factor=2,
+                 jitter=True, stable=60, crash_loop=5,
+                 max_restarts=None):
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.factor = factor
+        self.jitter = jitter
+        self.stable = stable
+        self.crash_loop = crash_loop
+        self.max_restarts = max_restarts
+
+    def delay(self, failures) -> float:
+        delay = min(self.max_interval,
+                    self.interval * self.factor ** max(failures - 1, 0))
+        return random.uniform(0, delay) if self.jitter else delay
+
+class ServiceStats:
+    def __init__(self):
+        # pending, running, restarting, stopped or gave up
+        self.state = "pending"
+        self.starts = 0
+        self.restarts = 0
+        self.crashes = 0
+        # consecutive failures since last stable run
+        self.failures = 0
+        self.last_error = None
+        self.last_error_time = None
+        self.last_start = None
+        self.last_stop = None
+        self.gave_up = False
+
+    def uptime(self) -> float:
+        if self.last_start is None:
+            return 0.
+        end = time.time() if self.last_stop is None else self.last_stop
+        return end - self.last_start
+
+    def as_dict(self):
+        data = dict(self.__dict__)
+        data["uptime"] = self.uptime()
+        return data
+
+class Service:
+    """ Service function and the stop handler
+
+        Both sync and async functions are supported, the sync one is
+            executed in daemon thread and should poll `wait_or_exit`,
+            and the async one is cancelled while shutting down.
+    """
     def __init__(self, name):
         self._name = name
         self._func = None
         self._stop = None
+        self._reload = None
+        self._auto_reload = False
+        self._policy = RestartPolicy()
+        self.stats = ServiceStats()
 
     def register_func(self, func,
                       auto_reload=False,
-                      timeout=5):
+                      timeout=5,
+                      policy=None):
+        """ timeout: the base restart interval if policy is None """
         if self._func is not None:
             raise RuntimeError(
                 "service:{} has been registered".format(self._name))
 
+        self._func = func
         self._auto_reload = auto_reload
-        self._time_out = timeout
+        self._policy = policy or RestartPolicy(interval=timeout)
 
-        def catch_func(*args, **kw):
-            try:
-                func(*args, **kw)
-            except Exception as e:
-                logger.error(
-                    "service:{} raise exception: {}".format(
-                        self._name, e))
-
-        def wrapper_func(*args, **kw):
-            catch_func(*args, **kw)
+    def register_stop_func(self, func):
+        self._stop = func
 
-            while self._auto_reload:
-                logger.warning(" ".join([
-                    "service {} closed,".format(
-                        self._name),
-                    "restart in {} seconds".format(self._time_out)
-                ]))
-                # clear service context
-                if self._stop is not None:
-                    self._stop()
-                wait_or_exit(self._time_out)
+    def register_reload_func(self, func):
+        self._reload = func
 
-                catch_func(*args, **kw)
-        self._func = as_thread_func(wrapper_func)
+    def reloadable(self):
+        return self._reload is not None
 
-    def register_stop_func(self, func):
-        self._stop = func
+    async def call(self, func, *args, **kw):
+        import asyncio
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args, **kw)
+        return await run_in_thread(func, *args, **kw)
 
-    def serve(self, *args, **kw):
+    async def serve(self, quit, *args, **kw):
         if self._func is None:
             raise RuntimeError(
                 "service:{} has not been registered".format(self._name))
+
+        try:
+            await self.serve_loop(quit, *args, **kw)
+        finally:
+            self.stats.state = "gave up" if self.stats.gave_up \
+                else "stopped"
+
+    async def serve_loop(self, quit, *args, **kw):
+        import asyncio
+        stats, policy = self.stats, self._policy
+        while True:
+            stats.state = "running"
+            stats.starts += 1
+            stats.last_start, stats.last_stop = time.time(), None
+            with trace.span(self._name, cat="service",
+                            cycle=stats.restarts):
+                try:
+                    await self.call(self._func, *args, **kw)
+                except ServiceExit:
+                    return
+                except Exception as e:
+                    stats.crashes += 1
+                    stats.last_error = "{}: {}".format(
+                        type(e).__name__, e)
+                    stats.last_error_time = time.time()
+                    logger.error(
+                        "service:{} raise exception: {}".format(
+                            self._name, e))
+                finally:
+                    stats.last_stop = time.time()
+
+            if not self._auto_reload or quit.is_set():
+                return
+
+            if stats.uptime() >= policy.stable:
+                stats.failures = 0
+            stats.failures += 1
+            if policy.max_restarts is not None and \
+                    stats.failures > policy.max_restarts:
+                stats.gave_up = True
+                logger.error(
+                    "service {} failed {} times in a row, give up".format(
+                        self._name, stats.failures))
+                return
+
+            delay = policy.delay(stats.failures)
+            crash_loop = stats.failures >= policy.crash_loop
+            logger.log(
+                logging.ERROR if crash_loop else logging.WARNING,
+                " ".join([
+                    "service {} closed{},".format(
+                        self._name,
+                        " in crash loop" if crash_loop else ""),
+                    "restart in {:.1f} seconds".format(delay),
+                    "(failures: {}, last error: {})".format(
+                        stats.failures, stats.last_error),
+                ]))
+            trace.instant("restart " + self._name, cat="service",
+                          failures=stats.failures, delay=delay)
+            # clear service context
+            stats.state = "restarting"
+            await self.stop()
+            try:
+                await asyncio.wait_for(quit.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                stats.restarts += 1
+
+    async def stop(self):
+        if self._stop is None:
             return
-        return self._func(*args, **kw)
+        try:
+            await self.call(self._stop)
+        except Exception as e:
+            logger.error(
+                "service:{} stop handler raise exception: {}".format(
+                    self._name, e))
+
+    async def reload(self):
+        if self._reload is None:
+            return
+        try:
+            await self.call(self._reload)
+        except Exception as e:
+            logger.error(
+                "service:{} reload handler raise exception: {}".format(
+                    self._name, e))
+
+    def is_async(self):
+        import asyncio
+        return asyncio.iscoroutinefunction(self._func)
 
     def close(self):
         self._auto_reload = False
-        if self._stop is not None:
-            self._stop()
+
+# compatible name
+ThreadFunc = Service
 
 def register_service(name, **kw):
     def _func(func):
-        __REGISTER_SERVICES__.setdefault(name, ThreadFunc(name))
+        __REGISTER_SERVICES__.setdefault(name, Service(name))
         __REGISTER_SERVICES__[name].register_func(func, **kw)
         return func
     return _func
 
 def register_stop_handler(name):
     def _func(func):
-        __REGISTER_SERVICES__.setdefault(name, ThreadFunc(name))
+        __REGISTER_SERVICES__.setdefault(name, Service(name))
         __REGISTER_SERVICES__[name].register_stop_func(func)
         return func
     return _func
 
-def auto_close():
-    def _shut_down(signo=2, _frame=None):
-        print("")
+def register_reload_handler(name):
+    """ Handler is invoked on SIGHUP to apply the new configuration
+            without restarting the service.
+    """
+    def _func(func):
+        __REGISTER_SERVICES__.setdefault(name, Service(name))
+        __REGISTER_SERVICES__[name].register_reload_func(func)
+        return func
+    return _func
+
+# service execution modes, the process mode runs each service in a
+#   forked child process, so that the services don't compete for
+#   the interpreter lock.
+THREAD_MODE = "thread"
+PROCESS_MODE = "process"
+SERVICE_MODES = [THREAD_MODE, PROCESS_MODE]
+
+# services served by supervisor, like the process services
+__RUNNING_SERVICES__ = {}
+__SERVICE_MODE__ = THREAD_MODE
+__SERVICE_SHARDS__ = 1
+__LOG_QUEUE__ = None
+
+def set_service_mode(mode, shards=1):
+    """ shards: child processes per service in process mode, the
+            service should tolerate running concurrently.
+    """
+    global __SERVICE_MODE__, __SERVICE_SHARDS__
+    if mode not in SERVICE_MODES:
+        raise RuntimeError("unknown service mode: {}".format(mode))
+    __SERVICE_MODE__, __SERVICE_SHARDS__ = mode, max(shards, 1)
+
+def log_queue():
+    """ Queue of log records from child processes, the records are
+            handled by the loggers of parent process.
+    """
+    global __LOG_QUEUE__
+    if __LOG_QUEUE__ is not None:
+        return __LOG_QUEUE__
+
+    import multiprocessing
+    __LOG_QUEUE__ = multiprocessing.get_context("fork").Queue()
+    def _listen():
+        while True:
+            record = __LOG_QUEUE__.get()
+            logging.getLogger(record.name).handle(record)
+    Thread(target=_listen, name="service-log", daemon=True).start()
+    return __LOG_QUEUE__
+
+def _process_main(service, queue, conn, args, kw):
+    """ Child process runs the service once, restarted by parent """
+    signal.set_wakeup_fd(-1)
+    for sig in ('TERM', 'HUP'):
+        signal.signal(getattr(signal, 'SIG'+sig), signal.SIG_DFL)
+    # parent process coordinates the shutdown of terminal interrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import logging.handlers
+    logging.root.handlers = [logging.handlers.QueueHandler(queue)]
+    child = Service(service._name)
+    child.register_func(service._func)
+    child.register_stop_func(service._stop)
+    if service.reloadable():
+        child.register_reload_func(service._reload)
+    Supervisor({child._name: child}).run(*args, **kw)
+
+    conn.send(child.stats.last_error)
+    conn.close()
+    sys.exit(1 if child.stats.crashes else 0)
+
+class ProcessService(Service):
+    """ Run service in child process, and restart the process with
+            the restart policy of service.
+    """
+    def __init__(self, service, shard=None):
+        name = service._name if shard is None else \
+            "{}#{}".format(service._name, shard)
+        super().__init__(name)
+        self._service = service
+        self._proc = None
+        # process terminated by stop handler, which may be killed by
+        #   SIGTERM before the child supervisor handles it.
+        self._terminated = None
+        self.register_func(self.run_process,
+                           auto_reload=service._auto_reload,
+                           policy=service._policy)
+        self.register_stop_func(self.terminate)
+        if service.reloadable():
+            self.register_reload_func(self.signal_reload)
+
+    def signal_reload(self):
+        """ Child supervisor reloads the service on SIGHUP """
+        proc = self._proc
+        if proc is not None and proc.is_alive():
+            os.kill(proc.pid, signal.SIGHUP)
+
+    async def run_process(self, *args, **kw):
+        import multiprocessing
+        ctx = multiprocessing.get_context("fork")
+        reader, writer = ctx.Pipe(duplex=False)
+        self._proc = ctx.Process(
+            target=_process_main, name=self._name,
+            args=(self._service, log_queue(), writer, args, kw))
+        self._proc.start()
+        writer.close()
+        logger.info("service {} runs in process {}".format(
+            self._name, self._proc.pid))
+
+        await run_in_thread(self._proc.join)
+        error = None
+        try:
+            if reader.poll():
+                error = reader.recv()
+        except EOFError:
+            # child is killed before sending the last error
+            pass
+        reader.close()
+        if self._proc.exitcode != 0 and self._terminated is not self._proc:
+            raise RuntimeError(
+                "process exited with code {}, last error: {}".format(
+                    self._proc.exitcode, error))
+
+    def terminate(self):
+        proc = self._proc
+        if proc is None or not proc.is_alive():
+            return
+        # child supervisor stops the service gracefully
+        self._terminated = proc
+        proc.terminate()
+        proc.join(SHUTDOWN_DEADLINE)
+        if proc.is_alive():
+            logger.warning("kill service {} process {}".format(
+                self._name, proc.pid))
+            proc.kill()
+            proc.join()
+
+def service_stats(name=None):
+    """ Restart statistics of service, or all if name is None """
+    services = dict(__REGISTER_SERVICES__, **__RUNNING_SERVICES__)
+    if name is not None:
+        return services[name].stats
+    return {n: s.stats for n, s in services.items()}
+
+def reconnect(name):
+    """ Stop the current run of auto reload service from any thread,
+            and the service is restarted by its restart policy.
+    """
+    services = dict(__REGISTER_SERVICES__, **__RUNNING_SERVICES__)
+    if name not in services:
+        raise RuntimeError("service {} not found".format(name))
+    service = services[name]
+    if not service._auto_reload:
+        raise RuntimeError("service {} is not auto reload".format(name))
+    if __SUPERVISOR__ is None or __SUPERVISOR__.loop is None:
+        raise RuntimeError("services are not running")
+
+    import asyncio
+    asyncio.run_coroutine_threadsafe(
+        service.stop(), __SUPERVISOR__.loop).result(SHUTDOWN_DEADLINE)
+
+# companions run along with services in the supervisor, like the
+#   control endpoint, and are cancelled once services finished.
+__COMPANIONS__ = {}
+__SUPERVISOR__ = None
+
+def register_companion(name, func):
+    """ func: async function with the quit event as argument """
+    __COMPANIONS__[name] = func
+    return func
+
+class Supervisor:
+    """ Event loop owns all the registered services """
+    def __init__(self, services, deadline=None, companions={}):
+        self._services = services
+        self._companions = companions
+        self._deadline = deadline or SHUTDOWN_DEADLINE
+        self._quit = None
+        self.loop = None
+
+    def shutdown(self, signo=2):
+        if self._quit.is_set():
+            return
+
+        if signo == signal.SIGINT:
+            # new line after the terminal ^C
+            print("")
         logger.info("shutting down ...")
-        for event in __QUIT_EVENTS__:
+        self._quit.set()
+        __SHUTDOWN__.set()
+        for event in list(__QUIT_EVENTS__):
             event.set()
+        for service in self._services.values():
+            service.close()
+
+    def reload(self, signo=signal.SIGHUP):
+        import asyncio
+        logger.info("reloading ...")
+        for name, service in self._services.items():
+            if service.reloadable():
+                logger.info("reload service - {}".format(name))
+                asyncio.ensure_future(service.reload())
 
-        for name, func in __REGISTER_SERVICES__.items():
+    def install_signals(self, loop):
+        # SIGHUP shuts down the services if none of them is reloadable
+        reloadable = any([s.reloadable() for s in self._services.values()])
+        for sig in ('TERM', 'HUP', 'INT'):
+            signo = getattr(signal, 'SIG'+sig)
+            handler = self.reload if sig == 'HUP' and reloadable \
+                else self.shutdown
+            try:
+                loop.add_signal_handler(signo, handler, signo)
+            except (ValueError, RuntimeError):
+                # signal can only be handled in main thread
+                return
+
+    async def stop_all(self, tasks):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._deadline
+
+        for name, service in self._services.items():
             logger.info("stop service - {}".format(name))
-            func.close()
+        stops = [asyncio.ensure_future(s.stop()) \
+            for s in self._services.values()]
+        await asyncio.wait(stops, timeout=self._deadline)
+
+        for task, name in tasks.items():
+            if self._services[name].is_async():
+                task.cancel()
+
+        pending = [t for t in tasks if not t.done()]
+        if pending:
+            _, pending = await asyncio.wait(
+                pending, timeout=max(deadline - loop.time(), 0))
+        for task in pending:
+            logger.warning("service {} is not stopped in {}s".format(
+                tasks[task], self._deadline))
+            task.cancel()
+
+    async def main(self, *args, **kw):
+        import asyncio
+        self._quit = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.install_signals(self.loop)
 
-    for sig in ('TERM', 'HUP', 'INT'):
-        signal.signal(
-            getattr(signal, 'SIG'+sig),
-            _shut_down);
+        companions = [asyncio.ensure_future(func(self._quit)) \
+            for func in self._companions.values()]
+
+        tasks = {}
+        for name, service in self._services.items():
+            logger.info("start service - {}".format(name))
+            tasks[asyncio.ensure_future(
+                service.serve(self._quit, *args, **kw))] = name
+
+        quit_waiter = asyncio.ensure_future(self._quit.wait())
+        pending = set(tasks)
+        while pending and not self._quit.is_set():
+            _, pending = await asyncio.wait(
+                pending | {quit_waiter},
+                return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(quit_waiter)
+        quit_waiter.cancel()
+
+        if pending:
+            await self.stop_all({t: tasks[t] for t in pending})
+
+        for task in companions:
+            task.cancel()
+        await asyncio.gather(*companions, return_exceptions=True)
+
+    def run(self, *args, **kw):
+        import asyncio
+        asyncio.run(self.main(*args, **kw))
 
 def Run(*args, **kw):
-    auto_close()
+    """ Serve the registered services until all of them finished
+            or shutdown is requested via signals.
+    """
+    if not __REGISTER_SERVICES__:
+        return
+
+    services = __REGISTER_SERVICES__
+    if __SERVICE_MODE__ == PROCESS_MODE:
+        services = {}
+        for service in __REGISTER_SERVICES__.values():
+            shards = [None] if __SERVICE_SHARDS__ == 1 else \
+                range(__SERVICE_SHARDS__)
+            for shard in shards:
+                process = ProcessService(service, shard)
+                services[process._name] = process
+    __RUNNING_SERVICES__.update(services)
 
-    for name, func in __REGISTER_SERVICES__.items():
-        logger.info("start service - {}".format(name))
-        func.serve(*args, **kw)
+    global __SUPERVISOR__
+    __SUPERVISOR__ = Supervisor(services, companions=__COMPANIONS__)
+    __SUPERVISOR__.run(*args, **kw)
@@ -0,0 +1,89 @@
+""" Chrome Trace Spans
+
+    Record the duration spans of module dispatch, shell commands and
+    services, and write them as Chrome trace event JSON at process
+    exit, which can be loaded in `chrome://tracing` or Perfetto.
+
+    The spans are not recorded until `start` is invoked, aka the
+    global `--trace` option, so the instrumented code costs nearly
+    nothing by default.
+
+    >>> with trace.span("n2n.install.compile", cat="func") as args:
+    >>>     args["code"] = 0
+"""
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import functools
+import contextlib
+
+logger = logging.getLogger("trace")
+
+__EVENTS__ = []
+__THREADS__ = {}
+__TRACE_FILE__ = None
+
+def enabled() -> bool:
+    return __TRACE_FILE__ is not None
+
+def now_us() -> float:
+    return time.perf_counter_ns() / 1000
+
+def add_event(**event):
+    tid = threading.get_ident()
+    if tid not in __THREADS__:
+        __THREADS__[tid] = threading.current_thread().name
+    event.update(pid=os.getpid(), tid=tid)
+    __EVENTS__.append(event)
+
+@contextlib.contextmanager
+def span(name, cat="bbcode", **args):
+    """ Record complete event, the yielded arguments can be updated """
+    if not enabled():
+        yield args
+        return
+
+    start_ts = now_us()
+    try:
+        yield args
+    finally:
+        add_event(name=name, cat=cat, ph="X",
+                  ts=start_ts, dur=now_us() - start_ts,
+                  args={k: str(v) for k, v in args.items()})
+
+def instant(name, cat="bbcode", **args):
+    if enabled():
+        add_event(name=name, cat=cat, ph="i", s="t", ts=now_us(),
+                  args={k: str(v) for k, v in args.items()})
+
+def traced(name=None, cat="func"):
+    """ Record the function invocation as span """
+    def _func(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def _traced(*args, **kw):
+            with span(span_name, cat=cat):
+                return func(*args, **kw)
+        return _traced
+    return _func
+
+def dump(file_path):
+    events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+               "tid": tid, "args": {"name": name}} \
+        for tid, name in list(__THREADS__.items())]
+    events.extend(list(__EVENTS__))
+
+    with open(file_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    logger.info("trace events are written into {}".format(file_path))
+
+def start(file_path):
+    """ Start recording spans and dump at process exit """
+    global __TRACE_FILE__
+    if __TRACE_FILE__ is None:
+        atexit.register(lambda: dump(__TRACE_FILE__))
+    __TRACE_FILE__ = file_path
@@ -1,7 +1,8 @@
+import os
 import copy
 from os import path
 
-from bbcode.common import base, git, cmd
+from bbcode.common import base, git, cmd, task
 from .base import *
 
 @cmd.option("--branch", default="dev",
@@ -21,43 +22,58 @@ def download(args):
 @cmd.group("n2n.install")
 def compile(args):
     n2n_root = path.join(git.GIT_ROOT, N2N_NAME)
-    base.validate(path.exists(n2n_root),
+    base.validate(path.exists(base.abspath(n2n_root)),
                   "n2n project not exist")
-    with base.enter(path.join(n2n_root, BUILD_DIR), create=True):
-        CMAKE = ["cmake"]
-        if args.system:
-            CMAKE.append("-DCMAKE_INSTALL_PREFIX=" + args.install_dir)
-        CMAKE.append("..")
-        base.shell_exec(*CMAKE)
-
-        MAKE = []
-        if args.system:
-            MAKE.appen("sudo")
-        MAKE.extend(["make", "-j${nproc}"])
-        if args.system:
-            MAKE.append("install")
-        base.shell_exec(*MAKE)
+    build_dir = path.join(n2n_root, BUILD_DIR)
+    base.make_dirs(build_dir)
+
+    CMAKE = ["cmake"]
+    if args.system:
+        CMAKE.append("-DCMAKE_INSTALL_PREFIX=" + args.install_dir)
+    CMAKE.append("..")
+    base.run(CMAKE, cwd=build_dir)
+
+    MAKE = []
+    if args.system:
+        MAKE.append("sudo")
+    MAKE.extend(["make", "-j{}".format(os.cpu_count() or 1)])
+    if args.system:
+        MAKE.append("install")
+    base.run(MAKE, cwd=build_dir)
 
 N2N_CONF_DIR = "n2n/etc"
 
 def install_conf(args):
-    base.shell_exec("sudo cp -r ", N2N_CONF_DIR, "/")
-    base.shell_exec("sudo systemctl daemon-reload")
-    base.shell_exec("sudo update-rc.d n2n defaults")
+    base.run(["sudo", "cp", "-r", N2N_CONF_DIR, "/"])
+    base.run(["sudo", "systemctl", "daemon-reload"])
+    base.run(["sudo", "update-rc.d", "n2n", "defaults"])
 
 def remove_conf(args):
-    base.shell_exec("sudo systemctl stop n2n")
-    base.shell_exec("sudo rm -rf /etc/init.d/n2n")
+    base.run(["sudo", "systemctl", "stop", "n2n"])
+    base.run(["sudo", "rm", "-rf", "/etc/init.d/n2n"])
 
+@cmd.option("--force", action="store_true",
+            help="rerun all the install steps, ignore the stamps")
 @cmd.module("n2n.install", refs=["n2n.common"], as_main=True,
             help="n2n install sub command")
 def install(args):
-    download(args)
-
     n2n_root = path.join(git.GIT_ROOT, N2N_NAME)
     build_dir = path.join(n2n_root, BUILD_DIR)
-    compile(args)
+    git_dir = path.join(n2n_root, ".git")
 
+    graph = task.Graph("n2n.install")
+    graph.add("download", download,
+              outputs=[n2n_root],
+              params=[args.branch])
+    graph.add("compile", compile, deps=["download"],
+              inputs=[path.join(git_dir, "HEAD"),
+                      path.join(git_dir, "index")],
+              outputs=[path.join(build_dir, "edge"),
+                       path.join(build_dir, "supernode")],
+              params=[args.system, args.install_dir])
     if args.system:
-        install_conf(args)
+        graph.add("install_conf", install_conf, deps=["compile"],
+                  inputs=[N2N_CONF_DIR],
+                  outputs=["/etc/init.d/n2n"])
+    graph.run(args, force=args.force)
 
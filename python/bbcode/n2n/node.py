@@ -1,4 +1,5 @@
 import os
+import shlex
 from os import path
 
 from bbcode.common import base, git, cmd
@@ -18,7 +19,7 @@ from .base import *
             help="n2n node common")
 def common_opt(args, bin_path):
     if args.usage:
-        base.shell_exec(bin_path, "--help")
+        base.run([bin_path, "--help"], check=False, stream=False)
         os.sys.exit()
 
     RUN = ["sudo", bin_path, "-f"]
@@ -45,7 +46,7 @@ def super(args):
 
     RUN = common_opt(args, bin_path)
     RUN.extend(["-a", args.ip_pools])
-    base.shell_exec(*RUN)
+    base.run(RUN)
 
 @cmd.option("--super-url", metavar="URL",
             default="101.200.44.74:7654",
@@ -66,8 +67,9 @@ def edge(args):
     bin_path = path.join(bin_path, "edge")
 
     RUN = common_opt(args, bin_path)
-    RUN.extend(["-a", args.ip, "-c", args.community,
+    # ip option may contain multiple flags, like `-r -a dhcp:0.0.0.0`
+    RUN.extend(["-a", *shlex.split(args.ip), "-c", args.community,
                 "-l", args.super_url,
                 "-k", args.key])
-    base.shell_exec(*RUN)
+    base.run(RUN)
 
@@ -21,14 +21,14 @@ def status(args):
     n2n_root = path.join(git.GIT_ROOT, N2N_NAME)
     _info("N2N ROOT", n2n_root)
 
-    is_download = path.exists(n2n_root)
+    is_download = path.exists(base.abspath(n2n_root))
     _info("IS DOWNLOAD", "True" if is_download else "False")
 
     build_dir = path.join(n2n_root, BUILD_DIR)
-    is_build = path.exists(build_dir)
+    is_build = path.exists(base.abspath(build_dir))
     _info("IS BUILD", "True" if is_build else "False")
 
     if is_build:
         _info("BINARY PATH", "SYSTEM" if args.system else build_dir)
 
-    base.shell_exec("netcat -u", args.ip, args.port)
+    base.run(["netcat", "-u", args.ip, args.port], stream=False)
@@ -1,8 +1,7 @@
 import logging
-import subprocess
+from os import path
 
-from bbcode.common import base, cmd
-from bbcode.common.types import *
+from bbcode.common import base, cmd, cache, task
 
 SRC_LISTS = {
     "tsinghua" : """
@@ -50,8 +49,7 @@ def source_substutiation(args):
     with open(src_path, "r") as f:
         ori_src = f.read()
 
-    code_name = base.check_output("lsb_release", "-c", "-s")
-    code_name = bytes2str(code_name).strip()
+    code_name = cache.probe("lsb_release", "-c", "-s")
 
     src = SRC_LISTS[args.source].format(code_name=code_name)
     if args.source in ori_src:
@@ -60,18 +58,18 @@ def source_substutiation(args):
         return
 
     logger.debug("backup source list file into {}.bak".format(src_path))
-    base.shell_exec(
-        "sudo mv {fpath} {fpath}.bak".format(fpath=src_path))
+    base.run(["sudo", "mv", src_path, src_path + ".bak"])
     logger.debug("write new source to file: {}".format(src_path))
-    tmp_path = "/tmp/{}".format(src_path)
+    tmp_path = path.join("/tmp", path.basename(src_path))
     with open(tmp_path, "w") as f:
         f.write(src)
-    base.shell_exec(
-        "sudo mv {} {}".format(tmp_path, src_path))
+    base.run(["sudo", "mv", tmp_path, src_path])
 
 def system_install(*names):
-    for name in names:
-        base.shell_exec("sudo apt install", name)
+    # apt holds the dpkg lock, packages are installed in one batch
+    #   instead of concurrent processes, and apt may prompt for
+    #   confirmation.
+    base.run(["sudo", "apt", "install", *names], stream=False)
 
 @cmd.group("ubuntu.install", as_main=True,
            description=" ".join([
@@ -81,11 +79,21 @@ def system_install(*names):
            ]))
 def conda(args):
     conda_name = "Miniconda3-latest-Linux-x86_64.sh"
-    base.shell_exec(
-        "wget https://repo.anaconda.com/miniconda/",
-        conda_name)
-    base.shell_exec("bash", conda_name)
+    base.run(["wget", "https://repo.anaconda.com/miniconda/" + conda_name])
+    base.run(["bash", conda_name], stream=False)
 
+# apt indexes are refreshed once a day
+APT_TTL = 24 * 3600
+
+SYSTEM_PACKAGES = [
+    "python-dev", "build_essential",
+    "make", "cmake", "vim", "git",
+    "rsync", "ssh",
+    "tmux",
+]
+
+@cmd.option("--force", action="store_true",
+            help="rerun all the install steps, ignore the stamps")
 @cmd.module("ubuntu.install", as_main=True,
             help="ubuntu install tool",
             description="""
@@ -95,13 +103,18 @@ Ubuntu Install Module
     1. replace system source.list
 """)
 def ubuntu_install(args):
-    source_substutiation(args)
-
-    base.shell_exec("sudo apt update")
-    base.shell_exec("sudo apt upgrade")
-
-    system_install("python-dev", "build_essential")
-    system_install("make", "cmake", "vim", "git")
-    system_install("rsync", "ssh")
-    system_install("tmux")
+    graph = task.Graph("ubuntu.install")
+    graph.add("source", source_substutiation,
+              inputs=["/etc/apt/sources.list"],
+              params=[args.source])
+    graph.add("update",
+              lambda _: base.run(["sudo", "apt", "update"]),
+              deps=["source"], ttl=APT_TTL)
+    graph.add("upgrade",
+              lambda _: base.run(["sudo", "apt", "upgrade"], stream=False),
+              deps=["update"], ttl=APT_TTL)
+    graph.add("packages",
+              lambda _: system_install(*SYSTEM_PACKAGES),
+              deps=["upgrade"], params=SYSTEM_PACKAGES)
+    graph.run(args, force=args.force)
 
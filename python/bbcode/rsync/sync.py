@@ -10,19 +10,20 @@ logger = logging.getLogger("sync.conf")
             help="show sync progress")
 @cmd.group("rsync.conf", group_name="rsync flags",
            description="rsync common flags")
-def sync_impl(source, destination, args):
-    if not path.exists(source):
+def sync_impl(source, destination, args, pool=None):
+    if not path.exists(base.abspath(source)):
         logger.warning("skip not exists file: %s" % source)
         return
 
-    SYNC = ["rsync"]
-    base.shell_exec(
-        "rsync -avzch --partial",
-        "--progress" if args.progress else "-q",
-        source,
-        destination,
-        check_error=True,
-    )
+    # progress bar is refreshed in place, write into terminal directly
+    progress = args.progress and pool is None
+    SYNC = ["rsync", "-avzch", "--partial"]
+    SYNC.append("--progress" if progress else "-q")
+    SYNC.extend([source, destination])
+    if pool is None:
+        base.run(SYNC, stream=not progress)
+    else:
+        pool.submit(SYNC)
 
 __CONF_REG__ = {}
 __CONF_STR__ = ""
@@ -55,6 +56,10 @@ register_conf("npm",
 register_conf("ssh",
     ".ssh/config", ".ssh/authorized_keys", ".ssh/known_hosts")
 
+@cmd.option("-j", "--jobs",
+            type=int, default=1,
+            help="number of files to sync concurrently, " + \
+                "progress is disabled if more than 1, by default 1")
 @cmd.option("--append",
             action="append", default=[],
             help="add files into sync list")
@@ -92,10 +97,18 @@ def conf_sync(args):
 
     logger.info("rSync Files:\n\t%s" % " ".join(sync_files))
 
-    dest = args.destination
+    # arguments are not expanded by shell any more
+    dest = path.expanduser(args.destination)
     if not dest.endswith("/"):
         dest += "/"
 
-    for f in sync_files:
-        src = path.join(args.source, f)
-        sync_impl(src, dest, args)
+    if args.jobs <= 1:
+        for f in sync_files:
+            src = path.expanduser(path.join(args.source, f))
+            sync_impl(src, dest, args)
+        return
+
+    with base.JobPool(jobs=args.jobs, fail_fast=False) as pool:
+        for f in sync_files:
+            src = path.expanduser(path.join(args.source, f))
+            sync_impl(src, dest, args, pool=pool)
@@ -1,8 +1,12 @@
-from bbcode.common import cmd
+""" SSH Tools Module
+
+    The module interfaces are declared here, and implementations are
+    imported lazily via `cmd.lazy_func`, since the third libraries:
+    paramiko and sshtunnel are heavy to import for other modules.
+"""
+from bbcode.common import cmd, control
 
 from .base import *
-from . import key
-from . import tunnel, reverse_tunnel
 
 @cmd.module(
     "ssh", as_main=True,
@@ -21,3 +25,127 @@ def main(args):
 @cmd.group("ssh", group_name="secure shell connection")
 def group_func(args):
     pass
+
+@cmd.option("--key-file", metavar="FILE",
+            default=SSH_PKEY_FILE,
+            help="rsa private key, by default load path: ~/.ssh/id_rsa")
+@cmd.module("ssh.key", as_main=True,
+            description="load rsa configuration")
+@cmd.lazy_func("bbcode.ssh.key")
+def load_rsa(args):
+    pass
+
+@cmd.option("--max-restarts", type=int,
+            default=None, metavar="NUMBER",
+            help="give up after consecutive failures, " + \
+                "restart forever by default")
+@cmd.option("--max-interval", type=int,
+            default=300, metavar="SECONDS",
+            help="max ssh tunnel restart interval, the interval " + \
+                "is doubled with jitter for consecutive failures, " + \
+                "300 by default")
+@cmd.option("--interval", type=int,
+            default=10,
+            help="ssh tunnel restart interval for unknown error")
+@cmd.option("--local",
+            action="append", default=[],
+            help="local binding[listen] address, host[:port]")
+@cmd.option("--remote",
+            action="append", default=[],
+            help="remote listen[binding] address, host[:port]")
+@cmd.option("--password", default=None,
+            help="server password, this will be prompt if not set")
+@cmd.option("--key-file", metavar="FILE",
+            default=SSH_PKEY_FILE,
+            help="rsa private key, by default load path: ~/.ssh/id_rsa")
+@cmd.option("server",
+            help="ssh server address, [user@]hostname[:port]")
+@cmd.module("ssh.tunnel", as_main=True,
+            help="ssh tunnel tools",
+            description="""
+SSH Tunnel Tools
+
+  By default use formal direction, that is user
+    can connect a port of a remote server where only SSH is reachable,
+    or want to connect a private server which is ont directly visible
+    from the outside:
+
+    port forwarding map:
+        local(bind) <- 127.0.0.1 <- server <- remote(listen)
+    data flow:
+        user -> local -> 127.0.0.1 -> server -> remote
+
+  And for reverse tunnel, refers to the group option: --reverse
+""")
+@cmd.lazy_func("bbcode.ssh.tunnel", "tunnel")
+def ssh_tunnel(args):
+    pass
+
+@cmd.option("--config", metavar="FILE", default=None,
+            help="json file of reverse tunnel addresses, like " + \
+                "{\"local\": [\"host:port\"], \"remote\": [...]}, " + \
+                "appended to the command line addresses and " + \
+                "reloaded on SIGHUP without dropping connections")
+@cmd.option("--overflow", choices=["reject", "wait"],
+            default="reject",
+            help="policy for connections exceed the limit, " + \
+                "reject closes the channel, wait blocks the " + \
+                "transport, by default reject")
+@cmd.option("--engine", choices=["thread", "mux"],
+            default="thread",
+            help="forward each connection in its own thread, or " + \
+                "all connections in one selectors loop to scale " + \
+                "with thousands connections, by default thread")
+@cmd.option("--buffer-size", type=int,
+            default=128, metavar="KB",
+            help="forwarding buffer per direction in KiB, " + \
+                "128 by default")
+@cmd.option("--max-connections", type=int,
+            default=64, metavar="NUMBER",
+            help="max concurrent forwarding connections, 64 by default")
+@cmd.group("ssh.tunnel", as_main=True,
+           group_name="reverse.tunnel",
+           description="""
+  Reverse tunnel Group
+
+  User may want to export some local address's ports into
+    global internet in some specific scenarios, like do
+    reverse tunnel port mapping so that developers can access
+    company machines at home as an VPN does, but this is
+    somehow a light solution for programmers:
+
+    port forwarding map:
+        local(listen) -> 127.0.0.1 -> server -> remote(bind)
+    data flow:
+        local <- 127.0.0.1 <- server <- remote <- user
+""")
+@cmd.lazy_func("bbcode.ssh.reverse_tunnel", "reverse_tunnel")
+def ssh_reverse_tunnel(args):
+    pass
+
+@cmd.option("--socket", metavar="FILE",
+            default=control.socket_path("ssh.tunnel"),
+            help="control socket of running tunnel, by default " + \
+                control.socket_path("ssh.tunnel"))
+@cmd.option("target", nargs="?", default=None,
+            help="service name to reconnect, or channel id to close")
+@cmd.option("command",
+            choices=["services", "channels", "close", "reconnect"],
+            help="control command sent to running tunnel")
+@cmd.module("ssh.ctl", as_main=True,
+            help="running tunnel control tools",
+            description="""
+SSH Tunnel Control Tools
+
+  Inspect or manage the running tunnel via control socket, the
+    socket is started along with the services, refers to the
+    global option: --control-socket.
+
+    services: list services with state, uptime and restarts
+    channels: list reverse tunnel channels with peer, age and bytes
+    close ID: force close the reverse tunnel channel
+    reconnect NAME: reconnect the service, like ssh.tunnel.reverse
+""")
+@cmd.lazy_func("bbcode.ssh.ctl", "ctl")
+def ssh_ctl(args):
+    pass
@@ -1,6 +1,7 @@
 from os import path
 
 DEFAULT_SSH_DIRECTORY = path.expanduser("~/.ssh")
+SSH_PKEY_FILE = path.join(DEFAULT_SSH_DIRECTORY, "id_rsa")
 
 def parse_user(server):
     args = ([None] + server.split("@"))[-2:]
@@ -0,0 +1,32 @@
+import json
+import logging
+
+from bbcode.common import control
+
+logger = logging.getLogger("ssh.ctl")
+
+SERVICE_FIELDS = ["state", "uptime", "starts", "restarts",
+                  "failures", "last_error"]
+
+def ctl(args):
+    if args.command in ["close", "reconnect"] and args.target is None:
+        raise RuntimeError("command {} requires the target".format(
+            args.command))
+
+    result = control.request(args.socket, args.command,
+                             target=args.target)
+    if args.command == "services":
+        for s in result:
+            logger.info("%-24s %s" % (s["name"], " ".join([
+                "{}={}".format(f, round(s[f], 1) \
+                    if isinstance(s[f], float) else s[f]) \
+                for f in SERVICE_FIELDS])))
+    elif args.command == "channels":
+        for c in result:
+            logger.info("%-6d %-40s peer=%s age=%.1fs rx=%d tx=%d" % (
+                c["id"], c["info"], c["peer"], c["age"],
+                c["rx_bytes"], c["tx_bytes"]))
+        logger.info("{} channels".format(len(result)))
+    else:
+        logger.info(result if isinstance(result, str) \
+            else json.dumps(result))
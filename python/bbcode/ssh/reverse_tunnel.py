@@ -9,23 +9,30 @@ OS like unix, mac can not bind to port number lower than 1024
     method to implement a single-direction socket data flow.
 """
 
-from os import sys, path
+from os import path
+import json
+import time
 import socket
+import itertools
 import getpass
-import select
 import logging
 import threading
 
 import paramiko
 
-from bbcode.common import base, types
-from bbcode.common import cmd, log, thread
+from bbcode.common import base
+from bbcode.common import log, thread, trace, control
 
+from . import forward
 from .config import ssh_config
 from .base import *
 
 logger = logging.getLogger("ssh.tunnel.reverse")
+# the per-connection events flood the log under scan or reconnect
+#   storm, while the warnings and errors are always logged.
+logger.addFilter(log.RateLimitFilter(rate=1., burst=20, max_level=log.INFO))
 
+@trace.traced("ssh.connect", cat="ssh")
 def ssh_transport(server, key_file, password):
     user, server = parse_user(server)
     server = list(parse_url(server, 22))
@@ -56,7 +63,7 @@ def ssh_transport(server, key_file, password):
     try:
         client.connect(*server, **params)
     except Exception as e:
-        logger.error("Failed to connect to %s:%d - %r" % (*server, e))
+        logger.error("Failed to connect to %s:%d - %r", *server, e)
         raise e
         return None
 
@@ -65,115 +72,258 @@ def ssh_transport(server, key_file, password):
     ts.use_compression(compress=True)
     return ts
 
-__CHANNELS__ = []
+class Connection:
+    """ Forwarding connection between ssh channel and local socket """
+    __IDS__ = itertools.count(1)
+
+    def __init__(self, chan, sock, info):
+        self.id = next(Connection.__IDS__)
+        self.chan = chan
+        self.sock = sock
+        self.info = info
+        self.start = time.time()
+        # bytes from remote into local, and the reverse
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        # forwarding pair if driven by multiplexer
+        self.pair = None
+
+    def close(self):
+        if self.pair is not None and not self.pair.closed:
+            # closed in the multiplexer thread
+            self.pair.close()
+            return
+        self.chan.close()
+        self.sock.close()
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "info": self.info,
+            "peer": getattr(self.chan, "origin_addr", None),
+            "age": time.time() - self.start,
+            "rx_bytes": self.rx_bytes,
+            "tx_bytes": self.tx_bytes,
+        }
+
+__CHANNELS__ = {}
 __LOCK__ = threading.Lock()
 
-def handler(chan, local_address, info):
+def open_connection(chan, local_address, info, mux=None, on_close=None):
+    """ Connect local address, and add the pair into mux if set,
+            on_close is invoked once the connection is finished.
+    """
     sock = socket.socket()
     try:
         sock.connect(local_address)
     except Exception as e:
-        logger.error("connecting to %s:%d failed - %r" % (
-            *local_address, e))
+        logger.error("connecting to %s:%d failed - %r",
+                     *local_address, e)
         chan.close()
+        if on_close is not None:
+            on_close()
+        return None
+
+    conn = Connection(chan, sock, info)
+    def _close(pair):
+        close_connection(conn)
+        if on_close is not None:
+            on_close()
+
+    with __LOCK__:
+        # the pair is set before the connection is visible, and the
+        #   close callback in mux thread waits for the lock.
+        if mux is not None:
+            conn.pair = mux.add(chan, sock, conn, on_close=_close)
+        __CHANNELS__[conn.id] = conn
+    return conn
+
+def close_connection(conn):
+    with __LOCK__:
+        if __CHANNELS__.pop(conn.id, None) is not None:
+            conn.close()
+
+    logger.info("closing reverse tunnel for %s", conn.info)
+
+def handler(chan, local_address, info, buffer_size=forward.BUFFER_SIZE):
+    conn = open_connection(chan, local_address, info)
+    if conn is None:
         return
 
-    __LOCK__.acquire()
-    __CHANNELS__.append(chan)
-    __CHANNELS__.append(sock)
-    __LOCK__.release()
-
-    while chan.active:
-        rqst, _, _ = select.select([chan, sock], [], [], 5)
-
-        if chan in rqst:
-            data = chan.recv(1024)
-            if not data:
-                break
-            sock.sendall(data)
-
-        if sock in rqst:
-            data = sock.recv(1024)
-            if not data:
-                break
-            chan.sendall(data)
-
-    __LOCK__.acquire()
-    if chan in __CHANNELS__:
-        __CHANNELS__.remove(chan)
-        chan.close()
-    if sock in __CHANNELS__:
-        __CHANNELS__.remove(sock)
-        sock.close()
-    __LOCK__.release()
-
-    logger.info("closing reverse tunnel for %s" % info)
-
-@cmd.group("ssh.tunnel", as_main=True,
-           description="""
-  Reverse tunnel Group
-
-  User may want to export some local address's ports into
-    global internet in some specific scenarios, like do
-    reverse tunnel port mapping so that developers can access
-    company machines at home as an VPN does, but this is
-    somehow a light solution for programmers:
-
-    port forwarding map:
-        local(listen) -> 127.0.0.1 -> server -> remote(bind)
-    data flow:
-        local <- 127.0.0.1 <- server <- remote <- user
-""")
+    try:
+        forward.forward(chan, conn.sock, conn, buffer_size=buffer_size)
+    except OSError as e:
+        # the connection may be closed via control socket
+        logger.debug("reverse tunnel for %s broken - %r", info, e)
+    close_connection(conn)
+
+def mux_handler(mux, chan, local_address, info, on_close=None):
+    """ Connect local address, and forward in the multiplexer """
+    open_connection(chan, local_address, info, mux, on_close)
+
+@control.register_command("channels")
+def list_channels(request):
+    with __LOCK__:
+        return [c.as_dict() for c in __CHANNELS__.values()]
+
+@control.register_command("close")
+def close_channel(request):
+    with __LOCK__:
+        conn = __CHANNELS__.pop(int(request["target"]), None)
+    if conn is None:
+        raise RuntimeError("channel {} not found".format(request["target"]))
+    conn.close()
+    return "channel {} is closed".format(conn.id)
+
+def load_addresses(args):
+    """ Addresses of command line and the config file """
+    los, res = list(args.local), list(args.remote)
+    if args.config:
+        with open(base.abspath(args.config), "r") as f:
+            conf = json.load(f)
+        los.extend(conf.get("local", []))
+        res.extend(conf.get("remote", []))
+
+    if not los or not res:
+        raise RuntimeError(
+            "local and remote addresses are required, " + \
+            "via --local/--remote or --config")
+    return [tuple(parse_url(l, 22)) for l in los], \
+        [tuple(parse_url(r, 22)) for r in res]
+
 def reverse_tunnel(args):
-    los = [parse_url(l, 22) for l in args.local]
-    res = [parse_url(r, 22) for r in args.remote]
+    los, res = load_addresses(args)
+    pool = thread.ThreadPool(
+        "ssh.forward",
+        max_workers=args.max_connections,
+        max_queue=args.max_connections,
+        overflow=args.overflow)
+    # the pool only connects local address in mux engine, and the
+    #   slot is reserved before the connection is opened in pool.
+    mux = None
+    slots = threading.BoundedSemaphore(args.max_connections)
+    if args.engine == "mux":
+        mux = forward.Multiplexer(buffer_size=args.buffer_size << 10)
+        mux.start()
 
     def forward_handler(channel, remote_addr, server_addr):
-        logger.info("connecting reverse tunnel from %s:%d" % (
-            remote_addr[0], remote_addr[1]))
+        logger.info("connecting reverse tunnel from %s:%d",
+                    remote_addr[0], remote_addr[1])
         for local_addr in los:
             info = "%s:%s - %s - %s:%d" % (
                 *local_addr, args.server, *remote_addr)
-            thread.as_thread_func(handler)(
-                channel, local_addr, info)
+            try:
+                if mux is None:
+                    pool.submit(handler, channel, local_addr, info,
+                                args.buffer_size << 10)
+                    continue
+
+                if not slots.acquire(blocking=False):
+                    raise thread.PoolOverflow(
+                        "{} connections are forwarding".format(
+                            args.max_connections))
+                try:
+                    pool.submit(mux_handler, mux, channel, local_addr,
+                                info, on_close=slots.release)
+                except thread.PoolOverflow:
+                    slots.release()
+                    raise
+            except thread.PoolOverflow as e:
+                logger.warning("reject reverse tunnel for %s - %s", info, e)
+                channel.close()
 
     server_ts = None
+    # remote addresses forwarded on current transport, changed by the
+    #   service, reload and stop handler threads under lock.
+    forwards = []
+    forwards_lock = threading.Lock()
+
+    def request_forward(remote_address):
+        logger.info("request port forward %s:%d", *remote_address)
+        server_ts.request_port_forward(
+            *remote_address, handler=forward_handler)
+        forwards.append(remote_address)
+
+    def cancel_forward(remote_address):
+        logger.info("cancel port forward %s:%d", *remote_address)
+        forwards.remove(remote_address)
+        server_ts.cancel_port_forward(*remote_address)
 
     @thread.register_service(
         "ssh.tunnel.reverse",
         auto_reload=True,
-        timeout=args.interval)
+        policy=thread.RestartPolicy(
+            interval=args.interval,
+            max_interval=args.max_interval,
+            max_restarts=args.max_restarts))
     def start_tunnel_service():
-        global server_ts
-        server_ts = ssh_transport(
-            args.server, args.key_file, args.password)
-        if not server_ts:
+        nonlocal server_ts
+        # the stop handler closes the shared transport, the local one
+        #   is checked so that the loop exits once it is closed.
+        ts = ssh_transport(args.server, args.key_file, args.password)
+        if not ts:
             return
 
-        for remote_address in res:
-            server_ts.request_port_forward(
-                *remote_address, handler=forward_handler)
-
-        while server_ts.is_active():
-            thread.wait_or_exit(timeout=10)
+        with forwards_lock:
+            server_ts = ts
+            forwards.clear()
+            for remote_address in list(res):
+                request_forward(remote_address)
+
+        while ts.is_active():
+            thread.wait_or_exit(timeout=1)
+
+    @thread.register_reload_handler("ssh.tunnel.reverse")
+    def reload_tunnel_service():
+        """ Apply the config diff, the live channels are untouched
+
+            The new remotes are forwarded before the removed ones are
+                cancelled, and cancelled again if any request fails,
+                so the addresses are not changed partially.
+        """
+        new_los, new_res = load_addresses(args)
+        with forwards_lock:
+            if server_ts and server_ts.is_active():
+                apply_forwards(new_res)
+            # new channels are connected to the new local addresses
+            los[:] = new_los
+            res[:] = new_res
+
+    def apply_forwards(new_res):
+        added = [r for r in new_res if r not in forwards]
+        removed = [r for r in forwards if r not in new_res]
+        try:
+            try:
+                for remote_address in added:
+                    request_forward(remote_address)
+            except Exception:
+                for remote_address in added:
+                    if remote_address in forwards:
+                        cancel_forward(remote_address)
+                raise
+
+            for remote_address in removed:
+                cancel_forward(remote_address)
+        finally:
+            # paramiko clears the transport handler on cancel, which
+            #   is shared by the kept remotes.
+            if forwards:
+                server_ts._tcp_handler = forward_handler
 
     @thread.register_stop_handler("ssh.tunnel.reverse")
     def stop_tunnel_servive():
-        global server_ts
         if not server_ts:
             return
 
-        for remote_address in res:
-            server_ts.cancel_port_forward(*remote_address)
+        with forwards_lock:
+            for remote_address in list(forwards):
+                cancel_forward(remote_address)
 
         server_ts.close()
 
-        __LOCK__.acquire()
-        chan_to_rm = list(__CHANNELS__)
-        __CHANNELS__.clear()
-        __LOCK__.release()
-
-        for channel in chan_to_rm:
-            channel.close()
+        with __LOCK__:
+            conns = list(__CHANNELS__.values())
+            __CHANNELS__.clear()
 
-        server_ts = None
+        for conn in conns:
+            conn.close()
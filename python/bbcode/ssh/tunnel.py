@@ -8,53 +8,20 @@ import socketserver
 import paramiko
 import sshtunnel
 
-from bbcode.common import cmd, thread, log
+from bbcode.common import thread, log
 
 from . import key
 from .base import *
 
 logger = logging.getLogger("ssh.proxy")
 
-SSH_PKEY_FILE = path.join(DEFAULT_SSH_DIRECTORY, "id_rsa")
-
-@cmd.option("--interval", type=int,
-            default=10,
-            help="ssh tunnel restart interval for unknown error")
-@cmd.option("--local", required=True,
-            action="append", default=[],
-            help="local binding[listen] address, host[:port]")
-@cmd.option("--remote", required=True,
-            action="append", default=[],
-            help="remote listen[binding] address, host[:port]")
-@cmd.option("--password", default=None,
-            help="server password, this will be prompt if not set")
-@cmd.option("--key-file", metavar="FILE",
-            default=SSH_PKEY_FILE,
-            help="rsa private key, by default load path: ~/.ssh/id_rsa")
-@cmd.option("server",
-            help="ssh server address, [user@]hostname[:port]")
-@cmd.module("ssh.tunnel", as_main=True,
-            help="ssh tunnel tools",
-            description="""
-SSH Tunnel Tools
-
-  By default use formal direction, that is user
-    can connect a port of a remote server where only SSH is reachable,
-    or want to connect a private server which is ont directly visible
-    from the outside:
-
-    port forwarding map:
-        local(bind) <- 127.0.0.1 <- server <- remote(listen)
-    data flow:
-        user -> local -> 127.0.0.1 -> server -> remote
-
-  And for reverse tunnel, refers to the group option: --reverse
-""")
 def tunnel(args):
     user, server = parse_user(args.server)
     server = parse_url(server, 22)
     los = [parse_url(l, 22) for l in args.local]
     res = [parse_url(r, 22) for r in args.remote]
+    if not los or not res:
+        raise RuntimeError("--local and --remote are required")
     tunnel_params = {
         "ssh_username": user,
         "local_bind_addresses": los,
@@ -77,7 +44,10 @@ def tunnel(args):
     @thread.register_service(
         "ssh tunnel",
         auto_reload=True,
-        timeout=args.interval)
+        policy=thread.RestartPolicy(
+            interval=args.interval,
+            max_interval=args.max_interval,
+            max_restarts=args.max_restarts))
     def serve():
         global tunnel
 
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the bbcode package lives in the python directory
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,79 @@
+import os
+import time
+import threading
+
+import pytest
+
+from bbcode.common import base
+
+def test_run_capture():
+    result = base.run(["sh", "-c", "echo out; echo err >&2; exit 3"],
+                      check=False, capture=True, stream=False)
+    assert result.code == 3
+    assert result.output == "out\nerr"
+
+def test_run_capture_all_lines():
+    result = base.run(["seq", "200000"], capture=True, stream=False)
+    lines = result.output.split("\n")
+    assert len(lines) == 200000
+    assert lines[-1] == "200000"
+
+def test_run_timeout_kill():
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError, match="timeout"):
+        base.run(["sleep", "5"], timeout=0.2, capture=True)
+    assert time.perf_counter() - start < 2
+
+def test_run_grandchild_holds_pipe():
+    start = time.perf_counter()
+    result = base.run("sleep 3 & echo hi", shell=True,
+                      capture=True, stream=False)
+    assert result.output == "hi"
+    assert time.perf_counter() - start < 2
+
+def test_check_output():
+    assert base.check_output("echo", "hi") == b"hi"
+    with pytest.raises(RuntimeError, match="code 1"):
+        base.check_output("false")
+
+def test_job_pool_order():
+    with base.JobPool(jobs=3) as pool:
+        for i in range(3):
+            pool.submit(["sh", "-c", "sleep 0.{}; echo {}".format(3 - i, i)])
+        results = pool.wait()
+    assert [r.output for r in results] == ["0", "1", "2"]
+
+def test_job_pool_failure():
+    pool = base.JobPool(jobs=2, fail_fast=False)
+    pool.submit(["true"])
+    pool.submit(["false"])
+    pool.submit(["true"])
+    with pytest.raises(RuntimeError, match="code 1"):
+        pool.wait()
+
+def test_enter_scopes_cwd(tmp_path):
+    cwd = os.getcwd()
+    dirs = [tmp_path / "a", tmp_path / "b"]
+    outputs = {}
+
+    def _pwd(target):
+        with base.enter(str(target), create=True):
+            time.sleep(0.05)
+            outputs[target.name] = base.check_output("pwd").decode()
+
+    threads = [threading.Thread(target=_pwd, args=(d,)) for d in dirs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert outputs == {d.name: str(d) for d in dirs}
+    assert os.getcwd() == cwd
+
+    with base.enter(str(dirs[0])):
+        with base.JobPool(jobs=2) as pool:
+            pool.submit(["pwd"])
+            results = pool.wait()
+        assert base.abspath("x") == str(dirs[0] / "x")
+    assert results[0].output == str(dirs[0])
+    assert base.getcwd() == cwd
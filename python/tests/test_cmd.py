@@ -0,0 +1,178 @@
+import os
+import sys
+
+import pytest
+
+from bbcode.common import cmd
+from bbcode.common.cmd import CmdStorage, CmdName
+
+@pytest.fixture(autouse=True)
+def storage(monkeypatch):
+    """ Empty registry, restored after test """
+    monkeypatch.setattr(CmdStorage, "STORE", {})
+    monkeypatch.setattr(CmdStorage, "MODULES", {})
+    monkeypatch.setattr(CmdStorage, "PREPARE", None)
+    monkeypatch.setattr(CmdStorage, "TREE", None)
+
+def register_tool(calls):
+    @cmd.option("--control", help="value option")
+    @cmd.option("--verbose", action="store_true")
+    @cmd.module("tool", as_main=True)
+    def tool(args):
+        calls.append("tool")
+
+    @cmd.option("--dest")
+    @cmd.module("tool.sub", as_main=True)
+    def sub(args):
+        calls.append("sub")
+
+    @cmd.module("tool.other", as_main=True)
+    def other(args):
+        calls.append("other")
+
+def mod_path(argv):
+    CmdStorage.init_parsers(argv)
+    return [n.name.name for n in CmdStorage.resolve_path(argv)]
+
+def test_resolve_path_option_values():
+    calls = []
+    register_tool(calls)
+    assert mod_path(["tool", "--control", "other", "sub"]) == \
+        ["tool", "tool.sub"]
+    assert mod_path(["tool", "--control=other", "sub"]) == \
+        ["tool", "tool.sub"]
+    assert mod_path(["tool", "--verbose", "sub"]) == ["tool", "tool.sub"]
+
+def test_resolve_path_abbrev_options():
+    calls = []
+    register_tool(calls)
+    # argparse accepts the unique prefix of long option
+    assert mod_path(["tool", "--contr", "other", "sub"]) == \
+        ["tool", "tool.sub"]
+    assert mod_path(["tool", "--verb", "sub"]) == ["tool", "tool.sub"]
+
+    args = cmd.Run(["tool", "--contr", "other", "sub", "--dest", "x"])
+    assert calls == ["sub"]
+    assert (args.control, args.dest) == ("other", "x")
+
+def test_resolve_path_no_abbrev():
+    @cmd.option("--control")
+    @cmd.module("tool", as_main=True, allow_abbrev=False)
+    def tool(args):
+        pass
+
+    @cmd.module("tool.sub", as_main=True)
+    def sub(args):
+        pass
+
+    assert mod_path(["tool", "--contr", "sub"]) == ["tool", "tool.sub"]
+
+def test_reference_cycle():
+    @cmd.option("--a-opt")
+    @cmd.module("a", as_main=True, refs=["b"])
+    def a(args):
+        pass
+
+    @cmd.option("--b-opt")
+    @cmd.module("b", as_main=True, refs=["a"])
+    def b(args):
+        pass
+
+    @cmd.option("--c-opt")
+    @cmd.module("c", as_main=True, refs=["a"])
+    def c(args):
+        pass
+
+    CmdStorage.resolve()
+    groups = {name.name: set(str(g) for g in e.groups) \
+        for name, e in CmdStorage.MODULES.items()}
+    # cycle members share the groups of each other, and the referrer
+    #   of cycle has the groups of all the members.
+    assert groups["a"] == {"b"}
+    assert groups["b"] == {"a"}
+    assert groups["c"] == {"a", "b"}
+    modules = CmdStorage.MODULES
+    assert modules[CmdName("c")].groups[CmdName("b")] is \
+        modules[CmdName("a")].groups[CmdName("b")]
+
+    args = cmd.Run(["c", "--b-opt", "1", "--a-opt", "2"])
+    assert (args.a_opt, args.b_opt, args.c_opt) == ("2", "1", None)
+
+PACKAGE = """
+from bbcode.common import cmd
+
+@cmd.option("--name", default={default!r})
+@cmd.module("demo", as_main=True)
+def demo(args):
+    print("name:" + args.name)
+"""
+
+def write_package(root, default):
+    pkg = root / "demo_pkg"
+    pkg.mkdir(exist_ok=True)
+    (pkg / "__init__.py").write_text(PACKAGE.format(default=default))
+    return pkg
+
+def run_demo(monkeypatch, manifest, pkg, env=[]):
+    """ Run with a fresh registry as a new process does, returns the
+            option default and whether the manifest is rebuilt.
+    """
+    monkeypatch.setattr(CmdStorage, "STORE", {})
+    monkeypatch.setattr(CmdStorage, "MODULES", {})
+    monkeypatch.setattr(CmdStorage, "PREPARE", None)
+    sys.modules.pop("demo_pkg", None)
+
+    loaded = []
+    load_manifest = CmdStorage.load_manifest
+    def _load_manifest(*args):
+        loaded.append(load_manifest(*args))
+        return loaded[-1]
+    monkeypatch.setattr(CmdStorage, "load_manifest", _load_manifest)
+
+    args = cmd.Run(["demo"], packages=["demo_pkg"], manifest=manifest,
+                   sources=[str(pkg)], env=env)
+    return args.name, loaded == [False]
+
+def test_manifest_rebuild(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    manifest = str(tmp_path / "cache" / "manifest.pkl")
+    pkg = write_package(tmp_path, "old")
+
+    assert run_demo(monkeypatch, manifest, pkg) == ("old", True)
+    assert os.path.exists(manifest)
+    # up to date manifest skips the package import and resolve
+    assert run_demo(monkeypatch, manifest, pkg) == ("old", False)
+
+    # modified source makes the manifest stale
+    write_package(tmp_path, "new-default")
+    assert run_demo(monkeypatch, manifest, pkg) == ("new-default", True)
+    assert run_demo(monkeypatch, manifest, pkg) == ("new-default", False)
+
+    # same size, but the modification time is changed
+    write_package(tmp_path, "old-default")
+    stat = os.stat(pkg / "__init__.py")
+    os.utime(pkg / "__init__.py",
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert run_demo(monkeypatch, manifest, pkg) == ("old-default", True)
+
+def test_manifest_env_key(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    manifest = str(tmp_path / "manifest.pkl")
+    pkg = write_package(tmp_path, "old")
+
+    monkeypatch.setenv("DEMO_ENV", "1")
+    assert run_demo(monkeypatch, manifest, pkg, ["DEMO_ENV"])[1]
+    assert not run_demo(monkeypatch, manifest, pkg, ["DEMO_ENV"])[1]
+    monkeypatch.setenv("DEMO_ENV", "2")
+    assert run_demo(monkeypatch, manifest, pkg, ["DEMO_ENV"])[1]
+    monkeypatch.delenv("DEMO_ENV")
+    assert run_demo(monkeypatch, manifest, pkg, ["DEMO_ENV"])[1]
+
+def test_manifest_corrupted(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    manifest = tmp_path / "manifest.pkl"
+    pkg = write_package(tmp_path, "old")
+
+    manifest.write_bytes(b"broken")
+    assert run_demo(monkeypatch, str(manifest), pkg) == ("old", True)
+    assert run_demo(monkeypatch, str(manifest), pkg) == ("old", False)
@@ -0,0 +1,34 @@
+import os
+import sys
+import subprocess
+from os import path
+
+SCRIPT = path.join(path.dirname(path.dirname(path.dirname(
+    path.abspath(__file__)))), "script.py")
+
+def imported_modules(argv, cache_dir):
+    """ Modules imported by script invocation via -X importtime """
+    env = dict(os.environ, XDG_CACHE_HOME=str(cache_dir), BBCODE_SOCKET="")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", SCRIPT] + argv,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        text=True, timeout=60)
+    # importing the missing paramiko fails the invocation
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    return [line.split("|")[-1].strip() \
+        for line in proc.stderr.splitlines() \
+        if line.startswith("import time:")]
+
+def test_rsync_conf_never_imports_paramiko(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    cache_dir = tmp_path / "cache"
+
+    # the cold run resolves modules, and the warm one loads manifest
+    for argv in [["rsync", "conf", "-h"],
+                 ["rsync", "conf", "-h"],
+                 ["rsync", "conf", str(src), str(dst)]]:
+        modules = imported_modules(argv, cache_dir)
+        assert "bbcode.rsync.sync" in modules or "-h" in argv
+        assert not [m for m in modules if m.split(".")[0] == "paramiko"]
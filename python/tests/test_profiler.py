@@ -0,0 +1,19 @@
+import pstats
+
+from bbcode.common import thread, profiler
+
+def work():
+    return sum(i * i for i in range(10000))
+
+def test_cpu_profile_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(thread, "__THREAD_HOOKS__", [])
+    cpu = profiler.CpuProfiler()
+    cpu.start()
+    try:
+        thread.as_thread_func(work)().join()
+    finally:
+        cpu.stop(str(tmp_path / "test.cpu.pstats"))
+
+    stats = pstats.Stats(str(tmp_path / "test.cpu.pstats"))
+    funcs = [func for _, _, func in stats.stats]
+    assert "work" in funcs
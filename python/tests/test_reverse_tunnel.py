@@ -0,0 +1,216 @@
+import socket
+import logging
+import threading
+import argparse
+
+import pytest
+
+pytest.importorskip("paramiko")
+
+from bbcode.common import thread
+from bbcode.ssh import reverse_tunnel as rt
+
+class FakeTransport:
+    """ paramiko transport keeps one tcp handler for all forwards,
+            and clears it on cancel.
+    """
+    def __init__(self):
+        self.forwards = set()
+        self.cancelled = []
+        # addresses denied by server
+        self.denied = set()
+        self.active = True
+        self._tcp_handler = None
+
+    def request_port_forward(self, address, port, handler=None):
+        # server denies binding the forwarded address again
+        assert (address, port) not in self.forwards
+        if (address, port) in self.denied:
+            raise RuntimeError("TCP forwarding request denied")
+        self.forwards.add((address, port))
+        self._tcp_handler = handler
+
+    def cancel_port_forward(self, address, port):
+        self._tcp_handler = None
+        self.cancelled.append((address, port))
+        self.forwards.discard((address, port))
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+def tunnel_args(config, **kw):
+    return argparse.Namespace(**dict(dict(
+        local=["localhost:80"], remote=[], config=str(config),
+        server="user@host", key_file=None, password=None,
+        interval=1, max_interval=1, max_restarts=None,
+        max_connections=4, overflow="reject",
+        buffer_size=64, engine="thread"), **kw))
+
+def test_reload_keeps_forwarding(tmp_path, monkeypatch):
+    config = tmp_path / "tunnel.json"
+    config.write_text('{"remote": ["0.0.0.0:8000", "0.0.0.0:8001"]}')
+
+    ts = FakeTransport()
+    handled = []
+    monkeypatch.setattr(rt, "ssh_transport", lambda *args: ts)
+    monkeypatch.setattr(rt, "handler",
+                        lambda chan, local, info, *args: handled.append(info))
+
+    rt.reverse_tunnel(tunnel_args(config))
+    service = thread.__REGISTER_SERVICES__.pop("ssh.tunnel.reverse")
+    runner = threading.Thread(target=service._func, daemon=True)
+    runner.start()
+    try:
+        while len(ts.forwards) < 2:
+            runner.join(0.01)
+
+        config.write_text('{"remote": ["0.0.0.0:8001"]}')
+        service._reload()
+        assert ts.forwards == {("0.0.0.0", 8001)}
+        assert ts.cancelled == [("0.0.0.0", 8000)]
+
+        # new connection on the kept remote reaches handler
+        assert ts._tcp_handler is not None
+        ts._tcp_handler(object(), ("10.0.0.1", 40000), ("0.0.0.0", 8001))
+        for _ in range(100):
+            if handled:
+                break
+            runner.join(0.01)
+        assert handled == ["localhost:80 - user@host - 10.0.0.1:40000"]
+    finally:
+        ts.close()
+        for event in list(thread.__QUIT_EVENTS__):
+            event.set()
+        runner.join(1)
+
+def test_reload_failure_rolls_back(tmp_path, monkeypatch):
+    config = tmp_path / "tunnel.json"
+    config.write_text('{"remote": ["0.0.0.0:8000", "0.0.0.0:8001"]}')
+
+    ts = FakeTransport()
+    ts.denied.add(("0.0.0.0", 8003))
+    monkeypatch.setattr(rt, "ssh_transport", lambda *args: ts)
+
+    rt.reverse_tunnel(tunnel_args(config))
+    service = thread.__REGISTER_SERVICES__.pop("ssh.tunnel.reverse")
+    runner = threading.Thread(target=service._func, daemon=True)
+    runner.start()
+    try:
+        while len(ts.forwards) < 2:
+            runner.join(0.01)
+
+        config.write_text(
+            '{"remote": ["0.0.0.0:8001", "0.0.0.0:8002", "0.0.0.0:8003"]}')
+        with pytest.raises(RuntimeError):
+            service._reload()
+        # the requested 8002 is cancelled, and 8000 is kept
+        assert ts.forwards == {("0.0.0.0", 8000), ("0.0.0.0", 8001)}
+        assert ts.cancelled == [("0.0.0.0", 8002)]
+        assert ts._tcp_handler is not None
+
+        # the later reload applies the whole diff again
+        ts.denied.clear()
+        service._reload()
+        assert ts.forwards == {
+            ("0.0.0.0", 8001), ("0.0.0.0", 8002), ("0.0.0.0", 8003)}
+        assert ts._tcp_handler is not None
+    finally:
+        ts.close()
+        for event in list(thread.__QUIT_EVENTS__):
+            event.set()
+        runner.join(1)
+
+def test_stop_exits_cleanly(tmp_path, monkeypatch):
+    config = tmp_path / "tunnel.json"
+    config.write_text('{"remote": ["0.0.0.0:8000"]}')
+
+    ts = FakeTransport()
+    monkeypatch.setattr(rt, "ssh_transport", lambda *args: ts)
+
+    rt.reverse_tunnel(tunnel_args(config))
+    service = thread.__REGISTER_SERVICES__.pop("ssh.tunnel.reverse")
+    errors = []
+    def run():
+        try:
+            service._func()
+        except Exception as e:
+            errors.append(e)
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    while not ts.forwards:
+        runner.join(0.01)
+
+    # reconnect stops the current run, which returns without error
+    service._stop()
+    for event in list(thread.__QUIT_EVENTS__):
+        event.set()
+    runner.join(2)
+    assert not runner.is_alive()
+    assert errors == []
+    assert ts.forwards == set()
+
+def test_rate_limit_keeps_errors(caplog):
+    caplog.set_level(logging.INFO, logger=rt.logger.name)
+    for i in range(50):
+        rt.logger.info("closing reverse tunnel for %s", i)
+        rt.logger.error("connecting to %s:%d failed - %r",
+                        "localhost", 80, i)
+    levels = [r.levelno for r in caplog.records]
+    assert levels.count(logging.ERROR) == 50
+    assert levels.count(logging.INFO) < 50
+
+def test_mux_connections_bounded(tmp_path, monkeypatch):
+    config = tmp_path / "tunnel.json"
+    config.write_text('{"remote": ["0.0.0.0:8000"]}')
+    local = socket.socket()
+    local.bind(("127.0.0.1", 0))
+    local.listen(16)
+
+    ts = FakeTransport()
+    monkeypatch.setattr(rt, "ssh_transport", lambda *args: ts)
+    rt.reverse_tunnel(tunnel_args(
+        config, engine="mux", max_connections=2,
+        local=["127.0.0.1:%d" % local.getsockname()[1]]))
+    service = thread.__REGISTER_SERVICES__.pop("ssh.tunnel.reverse")
+    runner = threading.Thread(target=service._func, daemon=True)
+    runner.start()
+
+    def _connect(count):
+        channels = [socket.socketpair() for _ in range(count)]
+        for chan, _ in channels:
+            ts._tcp_handler(chan, ("10.0.0.1", 40000), ("0.0.0.0", 8000))
+        return channels
+
+    def _wait(count):
+        for _ in range(200):
+            if len(rt.__CHANNELS__) == count:
+                return
+            runner.join(0.01)
+        assert len(rt.__CHANNELS__) == count
+
+    try:
+        while not ts.forwards:
+            runner.join(0.01)
+
+        # the burst is accepted before any local connection opened
+        channels = _connect(4)
+        _wait(2)
+        assert sorted(c.fileno() == -1 for c, _ in channels) == \
+            [False, False, True, True]
+
+        # the slot is released once the pair is closed in mux thread
+        conn = rt.__CHANNELS__[min(rt.__CHANNELS__)]
+        rt.close_channel({"target": conn.id})
+        while not conn.pair.closed:
+            runner.join(0.01)
+        channels += _connect(1)
+        _wait(2)
+    finally:
+        service._stop()
+        for event in list(thread.__QUIT_EVENTS__):
+            event.set()
+        runner.join(1)
+        local.close()
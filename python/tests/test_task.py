@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from bbcode.common import task
+
+def make_graph(tmp_path, runs, **kw):
+    """ download -> compile, and the independent docs step """
+    src, binary = tmp_path / "src", tmp_path / "binary"
+
+    def _download(args):
+        runs.append("download")
+        src.write_text(args)
+    def _compile(args):
+        runs.append("compile")
+        binary.write_text(src.read_text())
+    def _docs(args):
+        runs.append("docs")
+
+    graph = task.Graph("test", stamp_dir=str(tmp_path / "stamps"))
+    graph.add("download", _download, outputs=[str(src)], **kw)
+    graph.add("compile", _compile, deps=["download"],
+              inputs=[str(src)], outputs=[str(binary)])
+    graph.add("docs", _docs, params={"lang": "en"})
+    return graph
+
+def status(graph):
+    return {s.name: s.status for s in graph.steps.values()}
+
+def test_graph_skip_up_to_date(tmp_path):
+    runs = []
+    graph = make_graph(tmp_path, runs)
+    graph.run("v1")
+    assert sorted(runs) == ["compile", "docs", "download"]
+    assert runs.index("download") < runs.index("compile")
+    assert set(status(graph).values()) == {task.DONE}
+
+    runs.clear()
+    graph.run("v1")
+    assert runs == []
+    assert set(status(graph).values()) == {task.SKIPPED}
+
+    graph.run("v1", force=True)
+    assert sorted(runs) == ["compile", "docs", "download"]
+
+def test_graph_rerun_dependents(tmp_path):
+    runs = []
+    graph = make_graph(tmp_path, runs)
+    graph.run("v1")
+
+    # missing output reruns the step, and the dependent steps
+    (tmp_path / "src").unlink()
+    runs.clear()
+    graph.run("v2")
+    assert runs == ["download", "compile"]
+    assert status(graph)["docs"] == task.SKIPPED
+    assert (tmp_path / "binary").read_text() == "v2"
+
+def test_graph_rerun_changed_inputs(tmp_path):
+    runs = []
+    graph = make_graph(tmp_path, runs)
+    graph.run("v1")
+
+    # the input is changed out of the graph
+    time.sleep(0.01)
+    (tmp_path / "src").write_text("patched")
+    runs.clear()
+    graph.run("v1")
+    assert runs == ["compile"]
+    assert status(graph)["download"] == task.SKIPPED
+
+def test_graph_rerun_changed_params(tmp_path):
+    runs = []
+    make_graph(tmp_path, runs).run("v1")
+
+    graph = make_graph(tmp_path, runs)
+    graph.steps["docs"].params = {"lang": "zh"}
+    runs.clear()
+    graph.run("v1")
+    assert runs == ["docs"]
+
+def test_graph_rerun_expired(tmp_path):
+    runs = []
+    make_graph(tmp_path, runs, ttl=0).run("v1")
+
+    time.sleep(0.01)
+    runs.clear()
+    make_graph(tmp_path, runs, ttl=0).run("v1")
+    assert runs == ["download", "compile"]
+
+def test_graph_failure(tmp_path):
+    runs = []
+    graph = make_graph(tmp_path, runs)
+    def _broken(args):
+        runs.append("download")
+        raise RuntimeError("network down")
+    graph.steps["download"].func = _broken
+
+    with pytest.raises(RuntimeError, match="network down"):
+        graph.run("v1")
+    assert status(graph) == {
+        "download": task.FAILED,
+        "compile": task.CANCELLED,
+        "docs": task.DONE,
+    }
+    # no stamp is written for the failed step
+    assert not (tmp_path / "stamps" / "download").exists()
+
+def test_graph_unknown_dep(tmp_path):
+    graph = task.Graph("test", stamp_dir=str(tmp_path))
+    with pytest.raises(RuntimeError, match="unknown"):
+        graph.add("compile", print, deps=["download"])
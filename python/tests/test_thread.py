@@ -0,0 +1,254 @@
+import os
+import time
+import signal
+import asyncio
+import threading
+
+import pytest
+
+from bbcode.common import thread
+
+@pytest.fixture(autouse=True)
+def reset_shutdown():
+    yield
+    thread.__SHUTDOWN__.clear()
+    thread.__QUIT_EVENTS__.clear()
+
+def kill_when(event, signo=signal.SIGTERM):
+    """ Send signal to current process once event is set """
+    def _kill():
+        if event.wait(5):
+            os.kill(os.getpid(), signo)
+    threading.Thread(target=_kill, daemon=True).start()
+
+def test_supervisor_shutdown_order():
+    events = []
+    started = threading.Event()
+    stopped = threading.Event()
+
+    sync = thread.Service("sync")
+    def _sync():
+        started.set()
+        # ignores the quit events, and exits after the stop handler
+        while not stopped.wait(0.01):
+            pass
+        events.append("sync exit")
+    sync.register_func(_sync)
+    def _stop():
+        events.append("sync stop")
+        stopped.set()
+    sync.register_stop_func(_stop)
+
+    aio = thread.Service("async")
+    async def _aio():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            events.append("async cancelled")
+            raise
+    aio.register_func(_aio)
+
+    async def _companion(quit):
+        await quit.wait()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            events.append("companion cancelled")
+            raise
+
+    kill_when(started)
+    thread.Supervisor({"sync": sync, "async": aio},
+                      companions={"c": _companion}).run()
+
+    # stop handlers run before the services are waited and cancelled,
+    #   and companions are cancelled after all services finished.
+    assert events[0] == "sync stop"
+    assert sorted(events[1:3]) == ["async cancelled", "sync exit"]
+    assert events[3:] == ["companion cancelled"]
+    assert sync.stats.state == "stopped"
+    assert aio.stats.state == "stopped"
+
+def test_supervisor_shutdown_deadline():
+    started = threading.Event()
+    service = thread.Service("stuck")
+    def _stuck():
+        started.set()
+        time.sleep(60)
+    service.register_func(_stuck)
+
+    kill_when(started)
+    start = time.perf_counter()
+    thread.Supervisor({"stuck": service}, deadline=0.3).run()
+    assert time.perf_counter() - start < 2
+
+def test_wait_or_exit_raises_on_shutdown():
+    exits = []
+    started = threading.Event()
+    service = thread.Service("poll")
+    def _poll():
+        started.set()
+        try:
+            while True:
+                thread.wait_or_exit(timeout=10)
+        except thread.ServiceExit:
+            exits.append("exit")
+            raise
+    service.register_func(_poll, auto_reload=True)
+
+    kill_when(started)
+    thread.Supervisor({"poll": service}).run()
+    assert exits == ["exit"]
+    assert service.stats.crashes == 0
+    assert service.stats.restarts == 0
+
+def test_restart_policy_backoff():
+    policy = thread.RestartPolicy(
+        interval=1, max_interval=5, factor=2, jitter=False)
+    assert [policy.delay(f) for f in range(1, 6)] == [1, 2, 4, 5, 5]
+
+def test_restart_policy_jitter():
+    policy = thread.RestartPolicy(interval=1, max_interval=4)
+    delays = [policy.delay(3) for _ in range(100)]
+    assert all(0 <= d <= 4 for d in delays)
+    assert len(set(delays)) > 1
+
+def test_restart_max_restarts():
+    calls = []
+    service = thread.Service("crash")
+    def _crash():
+        calls.append(time.perf_counter())
+        raise RuntimeError("boom {}".format(len(calls)))
+    service.register_func(_crash, auto_reload=True,
+                          policy=thread.RestartPolicy(
+                              interval=0.05, max_interval=0.1,
+                              jitter=False, max_restarts=2))
+
+    thread.Supervisor({"crash": service}).run()
+    stats = service.stats
+    assert len(calls) == 3
+    assert (stats.crashes, stats.restarts, stats.failures) == (3, 2, 3)
+    assert stats.gave_up and stats.state == "gave up"
+    assert stats.last_error == "RuntimeError: boom 3"
+    # the delays of failure 1 and 2 are 0.05 and 0.1
+    assert calls[1] - calls[0] >= 0.05
+    assert calls[2] - calls[1] >= 0.1
+
+def test_restart_stable_resets_failures():
+    calls = []
+    service = thread.Service("flaky")
+    def _flaky():
+        calls.append(1)
+        if len(calls) < 4:
+            time.sleep(0.06)
+            raise RuntimeError("flaky")
+    service.register_func(_flaky, policy=thread.RestartPolicy(
+        interval=0.01, jitter=False, stable=0.05, max_restarts=1),
+        auto_reload=True)
+
+    thread.Supervisor({"flaky": service}).run()
+    # the stable runs reset failures, and the quick 4th run gives up
+    assert len(calls) == 4
+    assert service.stats.restarts == 3
+    assert service.stats.failures == 2
+    assert service.stats.gave_up
+
+def busy_pool(overflow):
+    """ Pool of one worker blocked by the first task, and the second
+            task is queued.
+    """
+    release = threading.Event()
+    pool = thread.ThreadPool("test", max_workers=1, max_queue=1,
+                             overflow=overflow)
+    pool.submit(release.wait)
+    while pool.stats()["active"] < 1:
+        time.sleep(0.01)
+    pool.submit(release.wait)
+    return pool, release
+
+def wait_completed(pool, count):
+    for _ in range(200):
+        if pool.stats()["completed"] >= count:
+            return
+        time.sleep(0.01)
+    raise AssertionError("pool stats: {}".format(pool.stats()))
+
+def test_pool_overflow_reject():
+    pool, release = busy_pool(thread.ThreadPool.REJECT)
+    with pytest.raises(thread.PoolOverflow):
+        pool.submit(release.wait)
+    assert pool.stats()["rejected"] == 1
+
+    release.set()
+    wait_completed(pool, 2)
+    assert pool.stats()["workers"] == 1
+
+def test_pool_overflow_wait():
+    pool, release = busy_pool(thread.ThreadPool.WAIT)
+    submitter = threading.Thread(
+        target=pool.submit, args=(release.wait,), daemon=True)
+    submitter.start()
+    submitter.join(0.1)
+    assert submitter.is_alive()
+
+    release.set()
+    submitter.join(1)
+    assert not submitter.is_alive()
+    wait_completed(pool, 3)
+    assert pool.stats()["rejected"] == 0
+
+def test_pool_workers_bounded():
+    release = threading.Event()
+    names = set()
+    def _task():
+        names.add(threading.current_thread().name)
+        release.wait()
+
+    pool = thread.ThreadPool("bounded", max_workers=3, max_queue=10)
+    for _ in range(8):
+        pool.submit(_task)
+    release.set()
+    wait_completed(pool, 8)
+    assert pool.stats()["workers"] <= 3
+    assert len(names) <= 3
+
+def test_process_service_restarts():
+    def _crash():
+        raise RuntimeError("boom in {}".format(os.getpid()))
+    service = thread.Service("crash")
+    service.register_func(_crash, auto_reload=True,
+                          policy=thread.RestartPolicy(
+                              interval=0.05, jitter=False, max_restarts=1))
+    process = thread.ProcessService(service)
+
+    thread.Supervisor({process._name: process}).run()
+    stats = process.stats
+    assert (stats.crashes, stats.restarts) == (2, 1)
+    assert stats.gave_up
+    assert "process exited with code 1" in stats.last_error
+    # the error is raised in the child process
+    assert "boom in {}".format(os.getpid()) not in stats.last_error
+
+def test_process_service_shutdown():
+    pids = []
+    def _poll():
+        while True:
+            thread.wait_or_exit(timeout=10)
+    service = thread.Service("poll")
+    service.register_func(_poll, auto_reload=True)
+    process = thread.ProcessService(service, shard=0)
+
+    started = threading.Event()
+    def _watch():
+        while process._proc is None or not process._proc.is_alive():
+            time.sleep(0.01)
+        pids.append(process._proc.pid)
+        started.set()
+    threading.Thread(target=_watch, daemon=True).start()
+
+    kill_when(started)
+    thread.Supervisor({process._name: process}).run()
+    assert process._name == "poll#0"
+    assert pids and pids[0] != os.getpid()
+    # the child may be terminated before its supervisor starts
+    assert process._proc.exitcode in [0, -signal.SIGTERM]
+    assert process.stats.crashes == 0
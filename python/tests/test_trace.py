@@ -0,0 +1,15 @@
+from bbcode.common import trace
+
+@trace.traced("demo.connect", cat="ssh")
+def connect(host):
+    return host
+
+def test_traced(monkeypatch, tmp_path):
+    monkeypatch.setattr(trace, "__EVENTS__", [])
+    assert connect("a") == "a"
+    assert trace.__EVENTS__ == []
+
+    monkeypatch.setattr(trace, "__TRACE_FILE__", str(tmp_path / "t.json"))
+    assert connect("b") == "b"
+    assert [(e["name"], e["cat"], e["ph"]) for e in trace.__EVENTS__] == \
+        [("demo.connect", "ssh", "X")]
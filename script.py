@@ -6,9 +6,26 @@ from os import path
 __ROOT__ = path.dirname(path.realpath(__file__))
 sys.path.insert(0, path.join(__ROOT__, "python"))
 
-from bbcode.common import cmd, log, thread
-from bbcode import n2n, ssh, rsync, os
-from bbcode import code
+# forward command into the prewarmed server if it's running
+if __name__ == "__main__":
+    from bbcode.common import client
+    exit_code = client.forward(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+from bbcode.common import cmd, log, thread, base, trace
+
+# module packages are imported only if the manifest is outdated
+PACKAGES = [
+    "bbcode.n2n", "bbcode.ssh", "bbcode.rsync",
+    "bbcode.os", "bbcode.code", "bbcode.common.server",
+    "bbcode.common.cache",
+]
+MANIFEST_FILE = path.join(base.CACHE_ROOT, "cmd.manifest")
+# environments read by the option defaults, like the socket paths
+MANIFEST_ENV = ["HOME", "XDG_CACHE_HOME", "BBCODE_SOCKET"]
+# profiler.PROFILE_MODES, the profiler is imported only if enabled
+PROFILE_MODES = ["cpu", "mem", "wall"]
 
 @cmd.module("", as_main=True,
             description="""
@@ -22,6 +39,48 @@ Contact the developer: cunxinshuihua@gmail.com for more support.
 def main(args):
     cmd.CmdStorage.get_parser("").print_help()
 
+@cmd.option("--control-socket", metavar="FILE", default=None,
+            help="control socket served along with services, " + \
+                "by default {}".format(path.join(
+                    base.CACHE_ROOT, "control", "<module>.sock")))
+@cmd.option("--service-shards", metavar="NUMBER",
+            type=int, default=1,
+            help="child processes per service in process mode, " + \
+                "1 by default")
+@cmd.option("--service-mode",
+            choices=thread.SERVICE_MODES, default=thread.THREAD_MODE,
+            help="run services in threads of main process, " + \
+                "or in child processes to scale with cores, " + \
+                "by default {}".format(thread.THREAD_MODE))
+@cmd.option("--trace", metavar="FILE", default=None,
+            help="write chrome trace events of module function, " + \
+                "shell commands and services into file")
+@cmd.option("--profile-dir", metavar="PATH", default=".",
+            help="directory to write profile result, " + \
+                "current directory by default")
+@cmd.option("--profile", metavar="MODE",
+            choices=PROFILE_MODES, default=None,
+            help="profile module function and services, " + \
+                "available options: {}".format(PROFILE_MODES))
+@cmd.option("--log-backups", metavar="NUMBER",
+            type=int, default=10,
+            help="compressed log segments to keep, 10 by default")
+@cmd.option("--log-rotate", metavar="MB",
+            type=int, default=64,
+            help="rotate log file after size in MB, or after " + \
+                "one day, 64 by default")
+@cmd.option("--log-file", metavar="FILE", default=None,
+            help="write JSON lines logs into file besides the " + \
+                "terminal, the rotated segments are gzip-ed")
+@cmd.option("--log-queue-size", metavar="NUMBER",
+            type=int, default=8192,
+            help="records buffered by queue log backend, " + \
+                "the overflowed records are dropped and counted")
+@cmd.option("--log-backend",
+            choices=log.LOG_BACKENDS, default="sync",
+            help="write logs in the caller thread, or via " + \
+                "listener thread to not block the services, " + \
+                "by default sync")
 @cmd.option("-v", "--verbosity", metavar="LEVEL",
             choices=log.LOG_NAMES, default=log.level2name(log.DEBUG),
             help="log verbosity to pring information, " + \
@@ -29,9 +88,35 @@ def main(args):
                 " by default {}".format(log.level2name(log.DEBUG)))
 @cmd.prepare()
 def prepare_func(args):
-    log.Init(log.name2level(args.verbosity))
+    log.Init(log.name2level(args.verbosity),
+             backend=args.log_backend,
+             queue_size=args.log_queue_size,
+             log_file=args.log_file,
+             max_bytes=args.log_rotate << 20,
+             backups=args.log_backups)
+    if args.profile:
+        from bbcode.common import profiler
+        profiler.start(args.profile, args.cmd_module, args.profile_dir)
+    if args.trace:
+        trace.start(args.trace)
+    thread.set_service_mode(args.service_mode, args.service_shards)
+    serve_control(args)
+
+def serve_control(args):
+    """ Control endpoint served along with services, the module is
+            imported only if the services are started.
+    """
+    async def _serve(quit):
+        from bbcode.common import control
+        await control.serve(args.control_socket or \
+                            control.socket_path(args.cmd_module), quit)
+    thread.register_companion("control", _serve)
 
 if __name__ == "__main__":
-    cmd.Run()
+    cmd.Run(packages=PACKAGES,
+            manifest=MANIFEST_FILE,
+            sources=[path.realpath(__file__),
+                     path.join(__ROOT__, "python")],
+            env=MANIFEST_ENV)
     # run registered service if possible
     thread.Run()